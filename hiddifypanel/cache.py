@@ -1,4 +1,5 @@
 import os
+import threading
 from redis_cache import RedisCache, chunks, compact_dump
 import redis
 from pickle import dumps, loads
@@ -6,6 +7,59 @@ from loguru import logger
 
 redis_client = redis.from_url(os.environ["REDIS_URI_MAIN"])
 
+INVALIDATION_CHANNEL = "cache:invalidate"  # the messages are passed to the handlers registered by on_invalidation
+_invalidation_handlers = []
+_invalidation_listener_pid = None
+_invalidation_listener_lock = threading.Lock()
+
+
+def on_invalidation(handler):
+    '''
+    Registers handler(message: str) to be called in every process when an invalidation is published,
+    it's for the in-process caches in front of redis.
+    '''
+    _invalidation_handlers.append(handler)
+
+
+def publish_invalidation(message: str):
+    for handler in _invalidation_handlers:
+        handler(message)
+    try:
+        redis_client.publish(INVALIDATION_CHANNEL, message)
+    except Exception as err:
+        logger.opt(exception=err).error("Failed to publish the cache invalidation")
+
+
+def ensure_invalidation_listener():
+    '''
+    Starts the pub/sub listener of this process, it is started lazily so each forked worker has its own.
+    '''
+    global _invalidation_listener_pid
+    if _invalidation_listener_pid == os.getpid():
+        return
+    with _invalidation_listener_lock:
+        if _invalidation_listener_pid == os.getpid():
+            return
+
+        def handle(message):
+            data = message['data'].decode() if isinstance(message['data'], bytes) else str(message['data'])
+            for handler in _invalidation_handlers:
+                handler(data)
+
+        def on_error(err, pubsub, thread):
+            global _invalidation_listener_pid
+            logger.opt(exception=err).error("The cache invalidation listener is stopped, it is restarted on the next use")
+            thread.stop()
+            _invalidation_listener_pid = None
+
+        try:
+            pubsub = redis_client.pubsub(ignore_subscribe_messages=True)
+            pubsub.subscribe(**{INVALIDATION_CHANNEL: handle})
+            pubsub.run_in_thread(sleep_time=1, daemon=True, exception_handler=on_error)
+            _invalidation_listener_pid = os.getpid()
+        except Exception as err:
+            logger.opt(exception=err).warning("Failed to start the cache invalidation listener")
+
 
 class CustomRedisCache(RedisCache):
     def __init__(self, redis_client, prefix="rc", serializer=compact_dump, deserializer=loads, key_serializer=None, support_cluster=True, exception_handler=None):
@@ -21,6 +75,7 @@ class CustomRedisCache(RedisCache):
         try:
             for f in self.cached_functions:
                 f.invalidate_all()
+            publish_invalidation("*")
             logger.trace("Invalidating all cached functions")
             chunks_gen = chunks(f'{self.prefix}*', 5000)
             for keys in chunks_gen:
@@ -1,9 +1,20 @@
 
 
 class DriverABS:
-    def get_all_usage(self, users): pass
+    timeout = 30  # seconds, the default deadline of each call made through user_driver.run_on_drivers (see user_driver.driver_timeout)
+
+    def get_usage_map(self) -> dict: pass  # {uuid: usage_bytes} of all the users since the last call
     def get_enabled_users(self): pass
     def add_client(self, user): pass
     def remove_client(self, user): pass
 
+    # the batch versions, the drivers override them when they can apply a batch cheaper than one by one
+    def add_clients(self, users):
+        for user in users:
+            self.add_client(user)
+
+    def remove_clients(self, users):
+        for user in users:
+            self.remove_client(user)
+
     def is_enabled(self) -> bool: return False
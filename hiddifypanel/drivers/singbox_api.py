@@ -1,3 +1,4 @@
+import os
 import xtlsapi
 from hiddifypanel.models import *
 from .abstract_driver import DriverABS
@@ -7,18 +8,43 @@ from collections import defaultdict
 from hiddifypanel.cache import cache
 from loguru import logger
 
+_singbox_client = None
+_enabled_users = (None, {})  # (stat key of 01_api.json, the users parsed from it)
+
+
+def get_singbox_client() -> xtlsapi.SingboxClient:
+    # one grpc channel for the process, it is recreated by reset_singbox_client after a failure
+    global _singbox_client
+    if _singbox_client is None:
+        _singbox_client = xtlsapi.SingboxClient('127.0.0.1', 10086)
+    return _singbox_client
+
+
+def reset_singbox_client():
+    global _singbox_client
+    _singbox_client = None
+
 
 class SingboxApi(DriverABS):
     def is_enabled(self) -> bool: return True
 
     def get_singbox_client(self):
-        return xtlsapi.SingboxClient('127.0.0.1', 10086)
+        return get_singbox_client()
 
     def get_enabled_users(self):
+        '''
+        Returns the users of 01_api.json, the file is parsed again only when it is replaced or modified
+        '''
+        global _enabled_users
         config_dir = current_app.config['HIDDIFY_CONFIG_PATH']
-        with open(f"{config_dir}/singbox/configs/01_api.json") as f:
-            json_data = json.load(f)
-            return {u.split("@")[0]: 1 for u in json_data['experimental']['v2ray_api']['stats']['users']}
+        path = f"{config_dir}/singbox/configs/01_api.json"
+        st = os.stat(path)
+        key = (st.st_ino, st.st_mtime_ns, st.st_size)
+        if _enabled_users[0] != key:
+            with open(path) as f:
+                json_data = json.load(f)
+            _enabled_users = (key, {u.split("@")[0]: 1 for u in json_data['experimental']['v2ray_api']['stats']['users']})
+        return dict(_enabled_users[1])
 
     @cache.cache(ttl=300)
     def get_inbound_tags(self):
@@ -27,6 +53,7 @@ class SingboxApi(DriverABS):
             inbounds = [inb.name.split(">>>")[1] for inb in xray_client.stats_query('inbound')]
             # print(f"Success in get inbound tags {inbounds}")
         except Exception as e:
+            reset_singbox_client()
             print(f"error in get inbound tags {e}")
             inbounds = []
         return list(set(inbounds))
@@ -37,17 +64,26 @@ class SingboxApi(DriverABS):
     def remove_client(self, user):
         pass
 
-    def get_all_usage(self, users):
+    def add_clients(self, users):
+        pass
+
+    def remove_clients(self, users):
+        pass
+
+    def get_usage_map(self):
         xray_client = self.get_singbox_client()
-        usages = xray_client.stats_query('user', reset=True)
-        uuid_user_map = {u.uuid: u for u in users}
+        try:
+            usages = xray_client.stats_query('user', reset=True)
+        except Exception:
+            reset_singbox_client()
+            raise
         res = defaultdict(int)
         for use in usages:
             if "user>>>" not in use.name:
                 continue
             # print(use.name, use.value)
             uuid = use.name.split(">>>")[1].split("@")[0]
-            res[uuid_user_map[uuid]] += use.value  # uplink + downlink
+            res[uuid] += use.value  # uplink + downlink
         return res
         # return {u: self.get_usage_imp(u.uuid) for u in users}
 
@@ -2,10 +2,25 @@ import os
 from .abstract_driver import DriverABS
 from hiddifypanel.models import *
 import redis
+from loguru import logger
 
 USERS_SET = "ssh-server:users"
 USERS_USAGE = "ssh-server:users-usage"
-from loguru import logger
+USERS_MEMBERS = "ssh-server:users-members"  # uuid -> member of USERS_SET
+
+# reads and deletes the usage hash atomically, so bytes counted by the bridge meanwhile are not lost
+DRAIN_USAGE_SCRIPT = """
+local all = redis.call('HGETALL', KEYS[1])
+redis.call('DEL', KEYS[1])
+local res = {}
+for i = 1, #all, 2 do
+    if tonumber(all[i + 1]) ~= 0 then
+        res[#res + 1] = all[i]
+        res[#res + 1] = all[i + 1]
+    end
+end
+return res
+"""
 
 
 class SSHLibertyBridgeApi(DriverABS):
@@ -20,33 +35,67 @@ class SSHLibertyBridgeApi(DriverABS):
 
     def get_enabled_users(self):
         redis_client = self.get_ssh_redis_client()
-        members = redis_client.smembers(USERS_SET)
+        with redis_client.pipeline() as pipe:
+            pipe.smembers(USERS_SET)
+            pipe.hlen(USERS_MEMBERS)
+            members, members_count = pipe.execute()
+        if members_count != len(members):
+            self.__rebuild_members(members)
         return {m.split("::")[0]: 1 for m in members}
 
+    def __rebuild_members(self, members):
+        # the set is what the ssh server reads, the hash only indexes it by uuid
+        with self.get_ssh_redis_client().pipeline() as pipe:
+            pipe.delete(USERS_MEMBERS)
+            if members:
+                pipe.hset(USERS_MEMBERS, mapping={m.split("::")[0]: m for m in members})
+            pipe.execute()
+
     def add_client(self, user):
-        print(f'Adding SSH {user}')
+        self.add_clients([user])
+
+    def remove_client(self, user):
+        self.remove_clients([user])
+
+    def add_clients(self, users):
+        if not users:
+            return
+        logger.debug(f'Adding {len(users)} SSH clients')
         redis_client = self.get_ssh_redis_client()
-        redis_client.sadd(USERS_SET, f'{user.uuid}::{user.ed25519_public_key}')
+        uuids = [u.uuid for u in users]
+        old_members = redis_client.hmget(USERS_MEMBERS, uuids)
+        with redis_client.pipeline() as pipe:
+            for user, old_member in zip(users, old_members):
+                member = f'{user.uuid}::{user.ed25519_public_key}'
+                if old_member and old_member != member:
+                    pipe.srem(USERS_SET, old_member)
+                pipe.sadd(USERS_SET, member)
+                pipe.hset(USERS_MEMBERS, user.uuid, member)
+            pipe.execute()
         redis_client.save()
 
-    def remove_client(self, user):
+    def remove_clients(self, users):
+        if not users:
+            return
         redis_client = self.get_ssh_redis_client()
-        if user.ed25519_public_key is None:
-            members = redis_client.smembers(USERS_SET)
-            for member in members:
-                if member.startswith(user.uuid):
-                    redis_client.srem(USERS_SET, member)
-
-        redis_client.srem(USERS_SET, f'{user.uuid}::{user.ed25519_public_key}')
-        redis_client.hdel(USERS_USAGE, f'{user.uuid}')
+        uuids = [u.uuid for u in users]
+        members = redis_client.hmget(USERS_MEMBERS, uuids)
+        with redis_client.pipeline() as pipe:
+            for user, member in zip(users, members):
+                if member:
+                    pipe.srem(USERS_SET, member)
+                pipe.srem(USERS_SET, f'{user.uuid}::{user.ed25519_public_key}')
+            pipe.hdel(USERS_MEMBERS, *uuids)
+            pipe.hdel(USERS_USAGE, *uuids)
+            pipe.execute()
         redis_client.save()
 
-    def get_all_usage(self, users):
+    def get_usage_map(self):
         redis_client = self.get_ssh_redis_client()
-        allusage = redis_client.hgetall(USERS_USAGE)
-        redis_client.delete(USERS_USAGE)
-        return {u: int(allusage.get(u.uuid) or 0) for u in users}
-        return {u: self.get_usage_imp(u.uuid) for u in users}
+        if not hasattr(self, 'drain_usage_script'):
+            self.drain_usage_script = redis_client.register_script(DRAIN_USAGE_SCRIPT)
+        allusage = self.drain_usage_script(keys=[USERS_USAGE])
+        return {allusage[i]: int(allusage[i + 1]) for i in range(0, len(allusage), 2)}
 
     def get_usage_imp(self, client_uuid: str, reset: bool = True) -> int:
         redis_client = self.get_ssh_redis_client()
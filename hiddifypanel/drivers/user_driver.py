@@ -2,10 +2,15 @@ from .ssh_liberty_bridge_api import SSHLibertyBridgeApi
 from .xray_api import XrayApi
 from .singbox_api import SingboxApi
 from .wireguard_api import WireguardApi
+from .abstract_driver import DriverABS
 from hiddifypanel.models import *
 from hiddifypanel.panel import hiddify
 from collections import defaultdict
+from flask import current_app
+from typing import Any, Dict, List
 from loguru import logger
+import threading
+import time
 
 drivers = [XrayApi(), SingboxApi(), SSHLibertyBridgeApi(), WireguardApi()]
 
@@ -14,40 +19,82 @@ def enabled_drivers():
     return [d for d in drivers if d.is_enabled()]
 
 
-def get_users_usage(reset=True):
+def driver_timeout(driver: DriverABS) -> float:
+    '''
+    The deadline of the calls to the driver, from DRIVER_TIMEOUT_<CLASS NAME> (e.g. DRIVER_TIMEOUT_XRAYAPI)
+    or DRIVER_TIMEOUT of app.cfg, or driver.timeout
+    '''
+    config = current_app.config
+    return float(config.get(f'DRIVER_TIMEOUT_{driver.__class__.__name__.upper()}', config.get('DRIVER_TIMEOUT', driver.timeout)))
+
+
+def run_on_drivers(method: str, *args, error_msg: str = '') -> Dict[DriverABS, Any]:
+    '''
+    Calls the method on all the enabled drivers concurrently, each driver has its own deadline (driver_timeout).
+    The drivers that fail or miss their deadline are logged and left out of the result, so the others are not blocked.
+    A driver that misses its deadline is left running in a daemon thread, so it does not keep the process alive either.
+    '''
+    app = current_app._get_current_object()  # type: ignore
+    results = {}  # driver -> (succeeded, result or exception)
+
+    def call(driver):
+        with app.app_context():
+            start = time.monotonic()
+            try:
+                results[driver] = (True, getattr(driver, method)(*args))
+            except Exception as e:
+                results[driver] = (False, e)
+            finally:
+                logger.debug(f'{driver.__class__.__name__}.{method} took {time.monotonic() - start:.3f}s')
+
+    drivers = enabled_drivers()
+    if not drivers:
+        return {}
+    timeouts = {driver: driver_timeout(driver) for driver in drivers}
+    threads = {driver: threading.Thread(target=call, args=(driver,), name=f'driver-{driver.__class__.__name__}', daemon=True) for driver in drivers}
+    start = time.monotonic()
+    for thread in threads.values():
+        thread.start()
     res = {}
-    users = list(User.query.all())
+    for driver, thread in threads.items():
+        thread.join(timeout=max(0, start + timeouts[driver] - time.monotonic()))
+        if driver not in results:
+            hiddify.error(f'ERROR! {driver.__class__.__name__} timed out after {timeouts[driver]}s in {error_msg}')
+            logger.error(f'ERROR! {driver.__class__.__name__} timed out after {timeouts[driver]}s in {error_msg}')
+            continue
+        succeeded, result = results[driver]
+        if succeeded:
+            res[driver] = result
+        else:
+            hiddify.error(f'ERROR! {driver.__class__.__name__} has error in {error_msg} {result}')
+            logger.opt(exception=result).error(f'ERROR! {driver.__class__.__name__} has error in {error_msg} {result}')
+    return res
+
+
+def get_users_usage(reset=True):
+    '''
+    Returns {uuid: {'usage': bytes, 'devices': ''}} only for the uuids reported by the drivers,
+    the users are not loaded here so the cost scales with the active users.
+    '''
     res = defaultdict(lambda: {'usage': 0, 'devices': ''})
-    for driver in enabled_drivers():
-        try:
-            all_usage = driver.get_all_usage(users)
-            for user, usage in all_usage.items():
-                if usage:
-                    res[user]['usage'] += usage
-                # res[user]['devices'] +=usage
-        except Exception as e:
-            print(driver)
-            hiddify.error(f'ERROR! {driver.__class__.__name__} has error in update usage {e}')
-            logger.exception(f'ERROR! {driver.__class__.__name__} has error in update usage {e}')
+    for all_usage in run_on_drivers('get_usage_map', error_msg='update usage').values():
+        for uuid, usage in all_usage.items():
+            if usage:
+                res[uuid]['usage'] += usage
+            # res[user]['devices'] +=usage
     return res
 
 
 def get_enabled_users():
-    from collections import defaultdict
     d = defaultdict(int)
     total = 0
-    for driver in enabled_drivers():
-        try:
-            for u, v in driver.get_enabled_users().items():
-                # print(u, "enabled", v, driver)
-                if not v:
-                    continue
-                d[u] += 1
-            total += 1
-        except Exception as e:
-            print(driver)
-            hiddify.error(f'ERROR! {driver.__class__.__name__} has error in get_enabled users {e}')
-            logger.exception(f'ERROR! {driver.__class__.__name__} has error in get_enabled users {e}')
+    for enabled in run_on_drivers('get_enabled_users', error_msg='get_enabled users').values():
+        for u, v in enabled.items():
+            # print(u, "enabled", v, driver)
+            if not v:
+                continue
+            d[u] += 1
+        total += 1
     # print(d, total)
     res = defaultdict(bool)
     for u, v in d.items():
@@ -57,18 +104,26 @@ def get_enabled_users():
 
 
 def add_client(user: User):
-    for driver in enabled_drivers():
-        try:
-            driver.add_client(user)
-        except Exception as e:
-            hiddify.error(f'ERROR! {driver.__class__.__name__} has error {e} in add client for user={user.uuid} {e}')
-            logger.exception(f'ERROR! {driver.__class__.__name__} has error {e} in add client for user={user.uuid} {e}')
+    user.uuid  # loads the expired attributes here, not concurrently in the driver threads
+    run_on_drivers('add_client', user, error_msg=f'add client for user={user.uuid}')
 
 
 def remove_client(user: User):
-    for driver in enabled_drivers():
-        try:
-            driver.remove_client(user)
-        except Exception as e:
-            hiddify.error(f'ERROR! {driver.__class__.__name__} has error {e} in remove client for user={user.uuid}')
-            logger.exception(f'ERROR! {driver.__class__.__name__} has error {e} in remove client for user={user.uuid}')
+    user.uuid  # loads the expired attributes here, not concurrently in the driver threads
+    run_on_drivers('remove_client', user, error_msg=f'remove client for user={user.uuid}')
+
+
+def add_clients(users: List[User]):
+    if not users:
+        return
+    for user in users:
+        user.uuid  # loads the expired attributes here, not concurrently in the driver threads
+    run_on_drivers('add_clients', users, error_msg=f'add clients for {len(users)} users')
+
+
+def remove_clients(users: List[User]):
+    if not users:
+        return
+    for user in users:
+        user.uuid  # loads the expired attributes here, not concurrently in the driver threads
+    run_on_drivers('remove_clients', users, error_msg=f'remove clients for {len(users)} users')
@@ -1,13 +1,45 @@
 import json
 import os
+import subprocess
 
 from .abstract_driver import DriverABS
 from hiddifypanel.models import User, hconfig, ConfigEnum
+from hiddifypanel.database import db
 from hiddifypanel.panel.run_commander import Command, commander
 import redis
 
 
-USERS_USAGE = "wg:users-usage"
+USERS_USAGE = "wg:users-usage"  # removed, the previous json blob of all peers, migrated to WG_PEERS
+WG_PEERS = "wg:peers"  # wg public key -> json of {"uuid", "usage": {"down", "up"}} counters of the last tick
+
+
+def _peer_usage(rx, tx) -> dict:
+    # the counters of the server side, what is received from the peer is its download as the commander reports it
+    return {'down': int(rx), 'up': int(tx)}
+
+
+def parse_wg_transfer(raw_output: str) -> dict:
+    '''Parses the output of the update-wg-usage command, the "public-key rx tx" lines of wg show transfer'''
+    data = {}
+    for line in raw_output.split('\n'):
+        sections = line.split()
+        if len(sections) < 3:
+            continue
+        data[sections[0]] = _peer_usage(sections[1], sections[2])
+    return data
+
+
+def parse_wg_dump(raw_output: str) -> dict:
+    '''Parses the output of wg show all dump'''
+    data = {}
+    for line in raw_output.split('\n'):
+        sections = line.split('\t')
+        # interface lines have 5 fields, peer lines have 9:
+        # interface public-key preshared-key endpoint allowed-ips latest-handshake rx tx keepalive
+        if len(sections) != 9:
+            continue
+        data[sections[1]] = _peer_usage(sections[6], sections[7])
+    return data
 
 
 class WireguardApi(DriverABS):
@@ -24,46 +56,55 @@ class WireguardApi(DriverABS):
         super().__init__()
 
     def __get_wg_usages(self) -> dict:
-        raw_output = commander(Command.update_wg_usage, run_in_background=False)
-        data = {}
-        for line in raw_output.split('\n'):
-            if not line:
-                continue
-            sections = line.split()
-            if len(sections) < 3:
-                continue
-            data[sections[0]] = {
-                'down': int(sections[1]),
-                'up': int(sections[2]),
-            }
-        return data
+        if os.geteuid() == 0:
+            return parse_wg_dump(subprocess.check_output(['wg', 'show', 'all', 'dump']).decode())
+        return parse_wg_transfer(commander(Command.update_wg_usage, run_in_background=False))
 
     def __get_local_usage(self) -> dict:
-        usage_data = self.get_redis_client() .get(USERS_USAGE)
-        if usage_data:
-            return json.loads(usage_data)
-
-        return {}
-
-    def __sync_local_usages(self, users) -> dict:
+        redis_client = self.get_redis_client()
+        old_usage = redis_client.get(USERS_USAGE)
+        if old_usage:
+            local_usage = json.loads(old_usage)
+            with redis_client.pipeline() as pipe:
+                if local_usage:
+                    pipe.hset(WG_PEERS, mapping={wg_pub: json.dumps(u) for wg_pub, u in local_usage.items()})
+                pipe.delete(USERS_USAGE)
+                pipe.execute()
+            return local_usage
+
+        return {wg_pub.decode(): json.loads(u) for wg_pub, u in redis_client.hgetall(WG_PEERS).items()}
+
+    def __get_uuid_map(self, local_usage: dict, wg_pubs) -> dict:
+        uuid_map = {wg_pub: u['uuid'] for wg_pub, u in local_usage.items() if u.get('uuid')}
+        unknown = [wg_pub for wg_pub in wg_pubs if wg_pub not in uuid_map]
+        if unknown:
+            for wg_pub, uuid in db.session.query(User.wg_pub, User.uuid).filter(User.wg_pub.in_(unknown)):
+                uuid_map[wg_pub] = uuid
+        return uuid_map
+
+    def __sync_local_usages(self) -> dict:
         local_usage = self.__get_local_usage()
         wg_usage = self.__get_wg_usages()
         res = {}
+        changed = {}
         # remove local usage that is removed from wg usage
-        for local_wg_pub in local_usage.copy().keys():
-            if local_wg_pub not in wg_usage:
-                del local_usage[local_wg_pub]
-        uuid_map = {u.wg_pub: u for u in users}
-        for wg_pub, wg_usage in wg_usage.items():
-            user = uuid_map.get(wg_pub)
-            uuid = user.uuid if user else None
-            if not local_usage.get(wg_pub):
-                local_usage[wg_pub] = {"uuid": uuid, "usage": wg_usage}
-                continue
-            res[wg_pub] = self.calculate_reset(local_usage[wg_pub]['usage'], wg_usage)
-            local_usage[wg_pub] = {"uuid": uuid, "usage": wg_usage}
-
-        self.get_redis_client().set(USERS_USAGE, json.dumps(local_usage))
+        removed = [wg_pub for wg_pub in local_usage if wg_pub not in wg_usage]
+        uuid_map = self.__get_uuid_map(local_usage, wg_usage.keys())
+        for wg_pub, usage in wg_usage.items():
+            uuid = uuid_map.get(wg_pub)
+            last = local_usage.get(wg_pub)
+            if last and uuid:
+                res[uuid] = self.calculate_reset(last['usage'], usage)
+            if not last or last['usage'] != usage or last.get('uuid') != uuid:
+                changed[wg_pub] = json.dumps({"uuid": uuid, "usage": usage})
+
+        if changed or removed:
+            with self.get_redis_client().pipeline() as pipe:
+                if changed:
+                    pipe.hset(WG_PEERS, mapping=changed)
+                if removed:
+                    pipe.hdel(WG_PEERS, *removed)
+                pipe.execute()
 
         return res
 
@@ -73,27 +114,21 @@ class WireguardApi(DriverABS):
             'down': current_usage['down'] - last_usage['down'],
         }
 
+        # the counters are restarted from zero (e.g. the interface is recreated), so all of it is new usage
         if res['up'] < 0:
-            res['up'] = 0
+            res['up'] = current_usage['up']
         if res['down'] < 0:
-            res['down'] = 0
+            res['down'] = current_usage['down']
         return res
 
     def get_enabled_users(self):
+        '''
+        Returns the peers of the last usage sync, it runs no command
+        '''
         if not hconfig(ConfigEnum.wireguard_enable):
             return {}
-        usages = self.__get_wg_usages()
-        new_wg_pubs = set(usages.keys())
-        old_usages = self.__get_local_usage()
-        old_wg_pubs = set(old_usages.keys())
-        enabled = {u['uuid']: 1 for u in old_usages.values()}
-        not_included = new_wg_pubs - old_wg_pubs
-        if not_included:
-            users = User.query.filter(User.wg_pub.in_(not_included).all())
-            for u in users:
-                enabled[u.uuid] = 1
-
-        return enabled
+        local_usage = self.__get_local_usage()
+        return {u['uuid']: 1 for u in local_usage.values() if u.get('uuid')}
 
     def add_client(self, user):
         pass
@@ -101,14 +136,14 @@ class WireguardApi(DriverABS):
     def remove_client(self, user):
         pass
 
-    def get_all_usage(self, users, reset=True):
+    def add_clients(self, users):
+        pass
+
+    def remove_clients(self, users):
+        pass
+
+    def get_usage_map(self, reset=True):
         if not hconfig(ConfigEnum.wireguard_enable):
             return {}
-        all_usages = self.__sync_local_usages(users)
-        res = {}
-        for u in users:
-            if use := all_usages.get(u.wg_pub):
-                res[u] = use['up'] + use['down']
-            else:
-                res[u] = 0
-        return res
+        all_usages = self.__sync_local_usages()
+        return {uuid: use['up'] + use['down'] for uuid, use in all_usages.items()}
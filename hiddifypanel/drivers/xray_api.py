@@ -1,101 +1,140 @@
+import time
 import xtlsapi
+from xtlsapi.xray_api.app.stats.command import command_pb2 as stats_command_pb2
 from hiddifypanel.models import *
 from .abstract_driver import DriverABS
 from collections import defaultdict
-from hiddifypanel.cache import cache
+from hiddifypanel.cache import cache, redis_client
 from loguru import logger
 
+XRAY_USERS_KEY = "xray:users:"  # + inbound tag, the set of uuids last applied to the inbound
+XRAY_BOOT_TIME_KEY = "xray:boot-time"  # the boot time of xray that the applied users belong to
+
+proto_map = {
+    'vless': 'vless',
+    'realityin': 'vless',
+    'xtls': 'vless',
+    'quic': 'vless',
+    'trojan': 'trojan',
+    'vmess': 'vmess',
+    'ss': 'shadowsocks',
+    'v2ray': 'shadowsocks',
+    'kcp': 'vless',
+    'dispatcher': 'trojan',
+    'reality': 'vless'
+}
+
+_xray_client = None
+
+
+def get_xray_client() -> xtlsapi.XrayClient:
+    # one grpc channel for the process, grpc reconnects it when xray is restarted
+    global _xray_client
+    if _xray_client is None:
+        _xray_client = xtlsapi.XrayClient('127.0.0.1', 10085)
+    return _xray_client
+
+
+@cache.cache(ttl=600)
+def get_inbound_tag_protocols() -> dict:
+    '''
+    Returns {inbound tag: (proto_map key, protocol)} of the inbounds that accept users.
+    It is invalidated on xray restart and on apply (invalidate_inbound_tags).
+    '''
+    res = {}
+    for inb in get_xray_client().stats_query('inbound'):
+        t = inb.name.split(">>>")[1]
+        for p, protocol in proto_map.items():
+            if p in t:
+                res[t] = (p, protocol)
+                break
+    return res
+
+
+def invalidate_inbound_tags():
+    get_inbound_tag_protocols.invalidate_all()
+
 
 class XrayApi(DriverABS):
     def is_enabled(self) -> bool:
         return hconfig(ConfigEnum.core_type) == "xray"
 
     def get_xray_client(self):
-        if not hasattr(self, 'xray_client'):
-            self.xray_client = xtlsapi.XrayClient('127.0.0.1', 10085)
-        return self.xray_client
+        return get_xray_client()
 
     def get_enabled_users(self):
-        xray_client = self.get_xray_client()
-        usages = xray_client.stats_query('user', reset=True)
+        '''
+        Returns the users last applied to the inbounds, it costs no AlterInbound call unless xray is restarted
+        '''
+        boot_time = self._get_boot_time()
+        state_boot_time = self._get_state_boot_time()
+        # the uptime and the clock are not read at the same moment, so a small drift is not a restart
+        if state_boot_time is None or abs(boot_time - state_boot_time) > 30:
+            invalidate_inbound_tags()
+            tags = self.get_inbound_tags()
+            logger.info(f"xray is restarted, rebuilding the applied users of {tags}")
+            self._rebuild_state(tags)
+            redis_client.set(XRAY_BOOT_TIME_KEY, boot_time)
+        else:
+            tags = self.get_inbound_tags()
+
         res = defaultdict(int)
-        tags = set(self.get_inbound_tags())
-        for use in usages:
-            if "user>>>" not in use.name:
-                continue
-            uuid = use.name.split(">>>")[1].split("@")[0]
+        pipe = redis_client.pipeline()
+        for t in tags:
+            pipe.smembers(f'{XRAY_USERS_KEY}{t}')
+        for members in pipe.execute():
+            for uuid in members:
+                res[uuid.decode()] = 1
+        return res
+
+    def _get_boot_time(self) -> int:
+        uptime = self.get_xray_client().stats_stub.GetSysStats(stats_command_pb2.SysStatsRequest()).Uptime
+        return int(time.time()) - uptime
+
+    def _get_state_boot_time(self) -> int | None:
+        boot_time = redis_client.get(XRAY_BOOT_TIME_KEY)
+        return int(boot_time) if boot_time is not None else None
 
+    def _rebuild_state(self, tags):
+        '''
+        Finds the users of each inbound by trying to add them, it is O(users*tags) so it only runs after a restart
+        '''
+        xray_client = self.get_xray_client()
+        usages = xray_client.stats_query('user', reset=False)
+        uuids = {use.name.split(">>>")[1].split("@")[0] for use in usages if "user>>>" in use.name}
+        state = defaultdict(set)
+        tags = set(tags)
+        tag_protocols = get_inbound_tag_protocols()
+        for uuid in uuids:
             for t in tags.copy():
                 try:
-                    self.__add_uuid_to_tag(uuid, t)
+                    self.__add_uuid_to_tag(uuid, t, tag_protocols)
                     self._remove_client(uuid, [t], False)
-                    # print(f"Success add  {uuid} {t}")
-                    res[uuid] = 0
                 except ValueError:
                     # tag invalid
                     tags.remove(t)
-                    pass
                 except xtlsapi.xtlsapi.exceptions.EmailAlreadyExists as e:
-                    res[uuid] = 1
+                    state[t].add(uuid)
                 except Exception as e:
                     print(f"error {e}")
-                    res[uuid] = 0
 
-        return res
+        pipe = redis_client.pipeline()
+        for key in redis_client.scan_iter(f'{XRAY_USERS_KEY}*'):
+            pipe.delete(key)
+        for t, t_uuids in state.items():
+            pipe.sadd(f'{XRAY_USERS_KEY}{t}', *t_uuids)
+        pipe.execute()
 
-        # xray_client = self.get_xray_client()
-        # users = User.query.all()
-        # t = "xtls"
-        # protocol = "vless"
-        # enabled = {}
-        # for u in users:
-        #     uuid = u.uuid
-        #     try:
-        #         xray_client.add_client(t, f'{uuid}', f'{uuid}@hiddify.com', protocol=protocol, flow='xtls-rprx-vision', alter_id=0, cipher='chacha20_poly1305')
-        #         xray_client.remove_client(t, f'{uuid}@hiddify.com')
-        #         enabled[uuid] = 0
-        #     except xtlsapi.xtlsapi.exceptions.EmailAlreadyExists as e:
-        #         enabled[uuid] = 1
-        #     except Exception as e:
-        #         print(f"error {e}")
-        #         enabled[uuid] = e
-        # return enabled
-
-    # @cache.cache(ttl=300)
     def get_inbound_tags(self):
         try:
-            xray_client = self.get_xray_client()
-            inbounds = {inb.name.split(">>>")[1] for inb in xray_client.stats_query('inbound')}
-            # print(f"Success in get inbound tags {inbounds}")
+            return list(get_inbound_tag_protocols())
         except Exception as e:
             print(f"error in get inbound tags {e}")
-            inbounds = {}
-        return list(inbounds)
+            return []
 
-    def __add_uuid_to_tag(self, uuid, t):
+    def __add_uuid_to_tag(self, uuid, t, tag_protocols: dict):
         xray_client = self.get_xray_client()
-        proto_map = {
-            'vless': 'vless',
-            'realityin': 'vless',
-            'xtls': 'vless',
-            'quic': 'vless',
-            'trojan': 'trojan',
-            'vmess': 'vmess',
-            'ss': 'shadowsocks',
-            'v2ray': 'shadowsocks',
-            'kcp': 'vless',
-            'dispatcher': 'trojan',
-            'reality': 'vless'
-        }
-
-        def proto(t):
-            res = '', ''
-            for p, protocol in proto_map.items():
-                if p in t:
-                    res = p, protocol
-                    break
-            return res
-        p, protocol = proto(t)
+        p, protocol = tag_protocols.get(t, ('', ''))
         if not p:
             raise ValueError("incorrect tag")
         if (protocol == "vless" and p != "xtls" and p != "realityin") or "realityingrpc" in t:
@@ -104,24 +143,63 @@ class XrayApi(DriverABS):
             xray_client.add_client(t, f'{uuid}', f'{uuid}@hiddify.com', protocol=protocol,
                                    flow='xtls-rprx-vision', alter_id=0, cipher='chacha20_poly1305')
 
+    def _get_applied_tags(self, uuids, tags) -> dict:
+        '''
+        Returns {uuid: {tag: bool}} of the last applied state, with one redis round-trip
+        '''
+        pipe = redis_client.pipeline()
+        for uuid in uuids:
+            for t in tags:
+                pipe.sismember(f'{XRAY_USERS_KEY}{t}', uuid)
+        applied = iter(pipe.execute())
+        return {uuid: {t: next(applied) for t in tags} for uuid in uuids}
+
     def add_client(self, user):
-        uuid = user.uuid
-        xray_client = self.get_xray_client()
-        tags = self.get_inbound_tags()
+        self.add_clients([user])
 
-        for t in tags:
-            try:
-                self.__add_uuid_to_tag(uuid, t)
-                # print(f"Success add  {uuid} {t}")
-            except ValueError:
-                # tag invalid
-                pass
-            except Exception as e:
-                # print(f"error in add  {uuid} {t} {e}")
-                pass
+    def add_clients(self, users):
+        try:
+            tag_protocols = get_inbound_tag_protocols()
+        except Exception as e:
+            print(f"error in get inbound tags {e}")
+            return
+        tags = list(tag_protocols)
+        uuids = [u.uuid for u in users]
+        added = defaultdict(list)
+
+        # only the inbounds that do not have the user yet
+        for uuid, applied_tags in self._get_applied_tags(uuids, tags).items():
+            for t, applied in applied_tags.items():
+                if applied:
+                    continue
+                try:
+                    self.__add_uuid_to_tag(uuid, t, tag_protocols)
+                    # print(f"Success add  {uuid} {t}")
+                except ValueError:
+                    # tag invalid
+                    continue
+                except xtlsapi.xtlsapi.exceptions.EmailAlreadyExists:
+                    pass
+                except Exception as e:
+                    # print(f"error in add  {uuid} {t} {e}")
+                    continue
+                added[t].append(uuid)
+
+        pipe = redis_client.pipeline()
+        for t, t_uuids in added.items():
+            pipe.sadd(f'{XRAY_USERS_KEY}{t}', *t_uuids)
+        pipe.execute()
 
     def remove_client(self, user):
-        return self._remove_client(user.uuid)
+        self.remove_clients([user])
+
+    def remove_clients(self, users):
+        tags = self.get_inbound_tags()
+        uuids = [u.uuid for u in users]
+        # only the inbounds that have the user
+        for uuid, applied_tags in self._get_applied_tags(uuids, tags).items():
+            if user_tags := [t for t, applied in applied_tags.items() if applied]:
+                self._remove_client(uuid, user_tags)
 
     def _remove_client(self, uuid, tags=None, dolog=True):
         xray_client = self.get_xray_client()
@@ -136,20 +214,18 @@ class XrayApi(DriverABS):
                 if dolog:
                     logger.info(f"error in remove  {uuid} {t} {e}")
                 pass
+            redis_client.srem(f'{XRAY_USERS_KEY}{t}', uuid)
 
-    def get_all_usage(self, users):
+    def get_usage_map(self):
+        # unknown uuids are removed by the usage reconciliation of the panel
         xray_client = self.get_xray_client()
         usages = xray_client.stats_query('user', reset=True)
-        uuid_user_map = {u.uuid: u for u in users}
         res = defaultdict(int)
         for use in usages:
             if "user>>>" not in use.name:
                 continue
             uuid = use.name.split(">>>")[1].split("@")[0]
-            if u := uuid_user_map.get(uuid):
-                res[u] += use.value
-            else:
-                self._remove_client(uuid)
+            res[uuid] += use.value
         return res
 
     def get_usage_imp(self, uuid):
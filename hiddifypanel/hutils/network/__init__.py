@@ -2,4 +2,5 @@
 from . import auto_ip_selector
 # from .ip import get_domain_ip, get_socket_public_ip, get_interface_public_ip, get_ips, get_ip
 from .net import *
+from .resolver import get_cached_domains_ips, get_cached_domain_ips, refresh_domains_ips, get_direct_host_or_ip, refresh_direct_host_or_ip
 from . import cf_api
\ No newline at end of file
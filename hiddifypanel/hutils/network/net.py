@@ -256,8 +256,8 @@ def is_domain_use_letsencrypt(domain: str) -> bool:
         return False
 
 
-@cache.cache(ttl=300)
-def get_direct_host_or_ip(prefer_version: int) -> str:
+def _get_direct_host_or_ip(prefer_version: int) -> str:
+    # it is cached by resolver.get_direct_host_or_ip
     from hiddifypanel.models import Domain
     direct = Domain.query.filter(Domain.mode == DomainType.direct, Domain.sub_link_only == False).first()
     if not direct:
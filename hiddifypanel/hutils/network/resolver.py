@@ -0,0 +1,152 @@
+'''
+A resolver cache for the subscriptions, the entries are kept in redis (shared by the workers) and are
+refreshed in background threads, so the request path does not wait for the dns.
+An expired entry is still served until its refresh is done. A missing one (e.g. a new domain or after a redis
+restart) reads as None (unknown) until its refresh fills the cache.
+'''
+import ipaddress
+import json
+import os
+import queue
+import threading
+import time
+from typing import Callable, Iterable, Set, Union
+
+from flask import current_app, has_app_context
+from loguru import logger
+
+from hiddifypanel.cache import redis_client
+from .net import get_domain_ips, _get_direct_host_or_ip
+
+DNS_CACHE_KEY = "dns:"
+DNS_LOCK_KEY = "dns:lock:"
+DNS_TTL = 300  # seconds, after that the entry is refreshed
+DNS_NEGATIVE_TTL = 60  # for the domains that are not resolved
+DNS_STALE_TTL = 24 * 3600  # an expired entry is served until then, if its refresh fails
+DNS_LOCK_TTL = 60
+DNS_REFRESH_WORKERS = 4
+
+_refresh_queue = queue.Queue()
+_workers_pid = None
+_workers_lock = threading.Lock()
+_in_flight = set()  # the keys that are queued or being refreshed
+
+
+def _refresh_worker():
+    while True:
+        key, run = _refresh_queue.get()
+        try:
+            run()
+        finally:
+            with _workers_lock:
+                _in_flight.discard(key)
+
+
+def _start_workers():
+    # the threads of the parent are not copied to the forked workers, they are daemons so they never block the exit
+    global _refresh_queue, _workers_pid
+    if _workers_pid == os.getpid():
+        return
+    _refresh_queue = queue.Queue()
+    _in_flight.clear()
+    for i in range(DNS_REFRESH_WORKERS):
+        threading.Thread(target=_refresh_worker, name=f"dns-refresh-{i}", daemon=True).start()
+    _workers_pid = os.getpid()
+
+
+def _load_entries(keys: list[str]) -> dict:
+    if not keys:
+        return {}
+    try:
+        raw = redis_client.mget([DNS_CACHE_KEY + key for key in keys])
+    except Exception as err:
+        logger.opt(exception=err).warning("Failed to read the dns cache")
+        return {}
+    return {key: json.loads(value) for key, value in zip(keys, raw) if value}
+
+
+def _store_entry(key: str, value, ttl: int):
+    entry = {'value': value, 'expires': time.time() + ttl}
+    try:
+        redis_client.set(DNS_CACHE_KEY + key, json.dumps(entry), ex=DNS_STALE_TTL)
+    except Exception as err:
+        logger.opt(exception=err).warning("Failed to write the dns cache of {}", key)
+
+
+def _refresh(key: str, load: Callable, force=False):
+    '''Refreshes the key in background, unless it is already queued in this process'''
+    app = current_app._get_current_object() if has_app_context() else None
+
+    def run():
+        try:
+            # one worker of all the processes refreshes each key
+            if not redis_client.set(DNS_LOCK_KEY + key, 1, nx=True, ex=DNS_LOCK_TTL) and not force:
+                return
+            if app:
+                with app.app_context():
+                    value, ttl = load()
+            else:
+                value, ttl = load()
+            _store_entry(key, value, ttl)
+            redis_client.delete(DNS_LOCK_KEY + key)
+        except Exception as err:
+            logger.opt(exception=err).warning("Failed to refresh the dns cache of {}", key)
+
+    with _workers_lock:
+        _start_workers()
+        if key in _in_flight:
+            return
+        _in_flight.add(key)
+    _refresh_queue.put((key, run))
+
+
+def _resolve(domain: str):
+    ips = get_domain_ips(domain)
+    return [str(ip) for ip in ips], DNS_TTL if ips else DNS_NEGATIVE_TTL
+
+
+def get_cached_domains_ips(domains: Iterable[str]) -> dict[str, Set[Union[ipaddress.IPv4Address, ipaddress.IPv6Address]] | None]:
+    '''
+    Returns the cached ips of the domains, the expired and the missing ones are refreshed in background.
+    The missing ones are None (unknown) until then, the request is never blocked by the dns.
+    '''
+    domains = list(dict.fromkeys(domains))
+    entries = _load_entries(domains)
+    now = time.time()
+    values = {}
+    for domain in domains:
+        entry = entries.get(domain)
+        if not entry or entry['expires'] < now:
+            _refresh(domain, lambda domain=domain: _resolve(domain))
+        values[domain] = entry['value'] if entry else None
+
+    return {domain: None if value is None else {ipaddress.ip_address(ip) for ip in value} for domain, value in values.items()}
+
+
+def get_cached_domain_ips(domain: str) -> Set[Union[ipaddress.IPv4Address, ipaddress.IPv6Address]] | None:
+    return get_cached_domains_ips([domain])[domain]
+
+
+def refresh_domains_ips(domains: Iterable[str]):
+    '''Resolves the domains again in background, e.g. when they are changed'''
+    for domain in set(domains):
+        if domain:
+            _refresh(domain, lambda domain=domain: _resolve(domain), force=True)
+
+
+def get_direct_host_or_ip(prefer_version: int) -> str:
+    key = f'direct-host:{prefer_version}'
+    entry = _load_entries([key]).get(key)
+    if entry is None:
+        # nothing to serve yet, it is only done once since the stale entry is kept for a day
+        value, ttl = _get_direct_host_or_ip(prefer_version), DNS_TTL
+        _store_entry(key, value, ttl)
+        return value
+    if entry['expires'] < time.time():
+        _refresh(key, lambda: (_get_direct_host_or_ip(prefer_version), DNS_TTL))
+    return entry['value']
+
+
+def refresh_direct_host_or_ip():
+    for version in (4, 6):
+        _refresh(f'direct-host:{version}', lambda version=version: (_get_direct_host_or_ip(version), DNS_TTL), force=True)
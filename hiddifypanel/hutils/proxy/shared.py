@@ -6,8 +6,11 @@ import random
 import re
 import json
 from ipaddress import IPv4Address, IPv6Address
+from typing import Callable, NamedTuple
+from sqlalchemy import func, case, and_
 from hiddifypanel.cache import cache
-from hiddifypanel.models import Proxy, ProxyProto, ProxyL3, ProxyTransport, ProxyCDN, Domain, DomainType, ConfigEnum, hconfig, get_hconfigs
+from hiddifypanel.database import db
+from hiddifypanel.models import Proxy, ProxyProto, ProxyL3, ProxyTransport, ProxyCDN, Domain, DomainType, ConfigEnum, hconfig, get_hconfigs, get_config_revision
 from hiddifypanel import hutils
 
 
@@ -102,81 +105,112 @@ def is_tls(l3) -> bool:
     return 'tls' in l3 or "reality" in l3 or l3 in [ProxyL3.h3_quic]
 
 
+class ProxyRecord(NamedTuple):
+    '''The fields of Proxy that the subscriptions use, it is cached instead of the orm object'''
+    id: int
+    child_id: int
+    name: str
+    enable: bool
+    proto: str
+    l3: str
+    transport: str
+    cdn: str
+
+
+# (config, whether a proxy belongs to it), the proxies of the disabled configs are filtered out
+PROXY_FILTER_RULES: list[tuple[ConfigEnum, Callable[[ProxyRecord], bool]]] = [
+    (ConfigEnum.tuic_enable, lambda c: c.proto == ProxyProto.tuic),
+    (ConfigEnum.wireguard_enable, lambda c: c.proto == ProxyProto.wireguard),
+    (ConfigEnum.ssh_server_enable, lambda c: c.proto == ProxyProto.ssh),
+    (ConfigEnum.hysteria_enable, lambda c: c.proto == ProxyProto.hysteria2),
+    (ConfigEnum.shadowsocks2022_enable, lambda c: 'shadowsocks' == c.transport),
+    (ConfigEnum.ssfaketls_enable, lambda c: 'faketls' == c.transport),
+    (ConfigEnum.v2ray_enable, lambda c: 'v2ray' == c.proto),
+    (ConfigEnum.shadowtls_enable, lambda c: c.transport == 'shadowtls'),
+    (ConfigEnum.ssr_enable, lambda c: 'ssr' == c.proto),
+    (ConfigEnum.vmess_enable, lambda c: 'vmess' in c.proto),
+    (ConfigEnum.vless_enable, lambda c: 'vless' in c.proto and 'reality' not in c.l3),
+    (ConfigEnum.trojan_enable, lambda c: 'trojan' in c.proto),
+    (ConfigEnum.httpupgrade_enable, lambda c: ProxyTransport.httpupgrade in c.transport),
+    (ConfigEnum.splithttp_enable, lambda c: ProxyTransport.splithttp in c.transport),
+    (ConfigEnum.ws_enable, lambda c: ProxyTransport.WS in c.transport),
+    # (ConfigEnum.xtls_enable, lambda c: ProxyTransport.XTLS in c.transport),
+    (ConfigEnum.grpc_enable, lambda c: ProxyTransport.grpc in c.transport),
+    (ConfigEnum.tcp_enable, lambda c: 'tcp' in c.transport),
+    (ConfigEnum.h2_enable, lambda c: 'h2' in c.transport or c.l3 in [ProxyL3.tls_h2_h1, ProxyL3.tls_h2]),
+    (ConfigEnum.kcp_enable, lambda c: 'kcp' in c.l3),
+    (ConfigEnum.reality_enable, lambda c: 'reality' in c.l3),
+    (ConfigEnum.quic_enable, lambda c: 'h3_quic' in c.l3),
+    (ConfigEnum.http_proxy_enable, lambda c: 'http' == c.l3),
+]
+
+
+def _get_domain_modes() -> tuple[set, bool]:
+    '''Returns the modes of all the domains and whether a cdn domain has its own servernames, in one query'''
+    has_servernames = func.max(case((and_(Domain.servernames != "", Domain.servernames != Domain.domain), 1), else_=0))
+    rows = db.session.query(Domain.mode, has_servernames).group_by(Domain.mode).all()
+    modes = {mode for mode, _ in rows}
+    cdn_with_servernames = any(servernames for mode, servernames in rows if mode in [DomainType.cdn, DomainType.auto_cdn_ip])
+    return modes, cdn_with_servernames
+
+
 @cache.cache(ttl=300)
-def get_proxies(child_id: int = 0, only_enabled=False) -> list['Proxy']:
-    proxies = Proxy.query.filter(Proxy.child_id == child_id).all()
-    proxies = [c for c in proxies if 'restls' not in c.transport]
-
-    if not hconfig(ConfigEnum.tuic_enable, child_id):
-        proxies = [c for c in proxies if c.proto != ProxyProto.tuic]
-    if not hconfig(ConfigEnum.wireguard_enable, child_id):
-        proxies = [c for c in proxies if c.proto != ProxyProto.wireguard]
-    if not hconfig(ConfigEnum.ssh_server_enable, child_id):
-        proxies = [c for c in proxies if c.proto != ProxyProto.ssh]
-    if not hconfig(ConfigEnum.hysteria_enable, child_id):
-        proxies = [c for c in proxies if c.proto != ProxyProto.hysteria2]
-    if not hconfig(ConfigEnum.shadowsocks2022_enable, child_id):
-        proxies = [c for c in proxies if 'shadowsocks' != c.transport]
-
-    if not hconfig(ConfigEnum.ssfaketls_enable, child_id):
-        proxies = [c for c in proxies if 'faketls' != c.transport]
-    if not hconfig(ConfigEnum.v2ray_enable, child_id):
-        proxies = [c for c in proxies if 'v2ray' != c.proto]
-    if not hconfig(ConfigEnum.shadowtls_enable, child_id):
-        proxies = [c for c in proxies if c.transport != 'shadowtls']
-    if not hconfig(ConfigEnum.ssr_enable, child_id):
-        proxies = [c for c in proxies if 'ssr' != c.proto]
-    if not hconfig(ConfigEnum.vmess_enable, child_id):
-        proxies = [c for c in proxies if 'vmess' not in c.proto]
-    if not hconfig(ConfigEnum.vless_enable, child_id):
-        proxies = [c for c in proxies if 'vless' not in c.proto or 'reality' in c.l3]
-    if not hconfig(ConfigEnum.trojan_enable, child_id):
-        proxies = [c for c in proxies if 'trojan' not in c.proto]
-    if not hconfig(ConfigEnum.httpupgrade_enable, child_id):
-        proxies = [c for c in proxies if ProxyTransport.httpupgrade not in c.transport]
-    if not hconfig(ConfigEnum.splithttp_enable, child_id):
-        proxies = [c for c in proxies if ProxyTransport.splithttp not in c.transport]
-    if not hconfig(ConfigEnum.ws_enable, child_id):
-        proxies = [c for c in proxies if ProxyTransport.WS not in c.transport]
-    # if not hconfig(ConfigEnum.xtls_enable, child_id):
-        #     proxies = [c for c in proxies if ProxyTransport.XTLS not in c.transport]
-    if not hconfig(ConfigEnum.grpc_enable, child_id):
-        proxies = [c for c in proxies if ProxyTransport.grpc not in c.transport]
-    if not hconfig(ConfigEnum.tcp_enable, child_id):
-        proxies = [c for c in proxies if 'tcp' not in c.transport]
-    if not hconfig(ConfigEnum.h2_enable, child_id):
-        proxies = [c for c in proxies if 'h2' not in c.transport and c.l3 not in [ProxyL3.tls_h2_h1, ProxyL3.tls_h2]]
-    if not hconfig(ConfigEnum.kcp_enable, child_id):
-        proxies = [c for c in proxies if 'kcp' not in c.l3]
-    if not hconfig(ConfigEnum.reality_enable, child_id):
-        proxies = [c for c in proxies if 'reality' not in c.l3]
-    if not hconfig(ConfigEnum.quic_enable, child_id):
-        proxies = [c for c in proxies if 'h3_quic' not in c.l3]
-    if not hconfig(ConfigEnum.http_proxy_enable, child_id):
-        proxies = [c for c in proxies if 'http' != c.l3]
-
-    if not Domain.query.filter(Domain.mode.in_([DomainType.cdn, DomainType.auto_cdn_ip])).first():
-        proxies = [c for c in proxies if c.cdn != "CDN"]
-
-    if not Domain.query.filter(Domain.mode.in_([DomainType.relay])).first():
-        proxies = [c for c in proxies if c.cdn != ProxyCDN.relay]
-
-    if not Domain.query.filter(Domain.mode.in_([DomainType.cdn, DomainType.auto_cdn_ip]), Domain.servernames != "", Domain.servernames != Domain.domain).first():
-        proxies = [c for c in proxies if 'Fake' not in c.cdn]
-    proxies = [c for c in proxies if not ('vless' == c.proto and ProxyTransport.tcp == c.transport and c.cdn == ProxyCDN.direct)]
-
-    if only_enabled:
-        proxies = [p for p in proxies if p.enable]
+def get_proxies(child_id: int = 0, only_enabled=False) -> list[ProxyRecord]:
+    hconfigs = get_hconfigs(child_id)
+    disabled_rules = [belongs for key, belongs in PROXY_FILTER_RULES if not hconfigs.get(key)]
+    modes, cdn_with_servernames = _get_domain_modes()
+    has_cdn = bool(modes & {DomainType.cdn, DomainType.auto_cdn_ip})
+    has_relay = DomainType.relay in modes
+
+    proxies = []
+    for p in Proxy.query.filter(Proxy.child_id == child_id).all():
+        c = ProxyRecord(p.id, p.child_id, p.name, p.enable, str(p.proto), str(p.l3), str(p.transport), str(p.cdn))
+        if 'restls' in c.transport or any(belongs(c) for belongs in disabled_rules):
+            continue
+        if not has_cdn and c.cdn == "CDN":
+            continue
+        if not has_relay and c.cdn == ProxyCDN.relay:
+            continue
+        if not cdn_with_servernames and 'Fake' in c.cdn:
+            continue
+        if 'vless' == c.proto and ProxyTransport.tcp == c.transport and c.cdn == ProxyCDN.direct:
+            continue
+        if only_enabled and not c.enable:
+            continue
+        proxies.append(c)
     return proxies
 
 
+# (domain, proxy, port option) -> the user independent part of make_proxy, valid for one config revision
+_proxy_templates = {}
+_proxy_templates_revision = None
+MAX_PROXY_TEMPLATES = 50000
+
+
+def _get_proxy_templates() -> dict:
+    global _proxy_templates, _proxy_templates_revision
+    revision = get_config_revision()
+    if revision != _proxy_templates_revision or len(_proxy_templates) > MAX_PROXY_TEMPLATES:
+        _proxy_templates = {}
+        _proxy_templates_revision = revision
+    return _proxy_templates
+
+
+def _domain_template_key(domain_db: Domain) -> tuple:
+    # the domains may be made per request (e.g. the auto cdn ip), so they are keyed on what make_proxy reads of them
+    return (domain_db.id, domain_db.domain, domain_db.child_id, domain_db.mode, domain_db.cdn_ip, domain_db.grpc, domain_db.servernames, domain_db.alias)
+
+
 def get_valid_proxies(domains: list[Domain]) -> list[dict]:
     allp = []
+    templates = _get_proxy_templates()
     allphttp = [p for p in request.args.get("phttp", "").split(',') if p]
     allptls = [p for p in request.args.get("ptls", "").split(',') if p]
     added_ip = defaultdict(set)
     configsmap = {}
     proxeismap = {}
+    # the domains are resolved in background, the ones that are not cached yet are None
+    domains_ips = hutils.network.get_cached_domains_ips(d.domain for d in domains if not d.cdn_ip)
     for domain in domains:
         if domain.child_id not in configsmap:
             configsmap[domain.child_id] = get_hconfigs(domain.child_id)
@@ -184,7 +218,10 @@ def get_valid_proxies(domains: list[Domain]) -> list[dict]:
         hconfigs = configsmap[domain.child_id]
         ips = domain.get_cdn_ips_parsed()
         if not ips:
-            ips = hutils.network.get_domain_ips(domain.domain)
+            ips = domains_ips[domain.domain] if domain.domain in domains_ips else hutils.network.get_cached_domain_ips(domain.domain)
+        if ips is None:
+            # not resolved yet, so its proxies can not be deduplicated and the subscription must not be cached
+            g.sub_uncacheable = True
         for proxy in proxeismap[domain.child_id]:
             noDomainProxies = False
             if proxy.proto in [ProxyProto.ssh, ProxyProto.wireguard]:
@@ -195,10 +232,10 @@ def get_valid_proxies(domains: list[Domain]) -> list[dict]:
             key = f'{proxy.proto}{proxy.transport}{proxy.cdn}{proxy.l3}'
 
             if proxy.proto in [ProxyProto.ssh, ProxyProto.tuic, ProxyProto.hysteria2, ProxyProto.wireguard, ProxyProto.ss]:
-                if noDomainProxies and all([x in added_ip[key] for x in ips]):
+                if noDomainProxies and ips is not None and all([x in added_ip[key] for x in ips]):
                     continue
 
-                for x in ips:
+                for x in ips or ():
                     added_ip[key].add(x)
 
                 if proxy.proto in [ProxyProto.ssh, ProxyProto.wireguard, ProxyProto.ss]:
@@ -228,14 +265,67 @@ def get_valid_proxies(domains: list[Domain]) -> list[dict]:
                             continue
                         options.append({'phttp': phttp, 'ptls': ptls})
 
+            domain_key = _domain_template_key(domain)
             for opt in options:
-                pinfo = make_proxy(hconfigs, proxy, domain, **opt)
-                if 'msg' not in pinfo:
-                    allp.append(pinfo)
+                template_key = (domain_key, proxy.id, tuple(sorted(opt.items())))
+                if (template := templates.get(template_key)) is None:
+                    template = templates[template_key] = make_proxy_template(hconfigs, proxy, domain, **opt)
+                if 'msg' not in template:
+                    allp.append(add_user_to_proxy(template, hconfigs, proxy, domain, g.account))
     return allp
 
 
-def make_proxy(hconfigs: dict, proxy: Proxy, domain_db: Domain, phttp=80, ptls=443, pport: int | None = None) -> dict:
+def make_proxy(hconfigs: dict, proxy: 'Proxy | ProxyRecord', domain_db: Domain, phttp=80, ptls=443, pport: int | None = None) -> dict:
+    template = make_proxy_template(hconfigs, proxy, domain_db, phttp, ptls, pport)
+    if 'msg' in template:
+        return template
+    return add_user_to_proxy(template, hconfigs, proxy, domain_db, g.account)
+
+
+def add_user_to_proxy(template: dict, hconfigs: dict, proxy: 'Proxy | ProxyRecord', domain_db: Domain, account) -> dict:
+    '''
+    Fills the user fields and the random choices in a copy of the template made by make_proxy_template
+    '''
+    base = {**template, 'uuid': str(account.uuid), 'dbe': proxy, 'dbdomain': domain_db}
+    if base['proto'] == ProxyProto.wireguard:
+        base['wg_pub'] = account.wg_pub
+        base['wg_pk'] = account.wg_pk
+        base['wg_psk'] = account.wg_psk
+        base['wg_ipv4'] = hutils.network.add_number_to_ipv4(hconfigs[ConfigEnum.wireguard_ipv4], account.id)
+        base['wg_ipv6'] = hutils.network.add_number_to_ipv6(hconfigs[ConfigEnum.wireguard_ipv6], account.id)
+        return base
+
+    if 'reality_short_id' in base:
+        base['reality_short_id'] = random.sample(hconfigs[ConfigEnum.reality_short_ids].split(','), 1)[0]
+        if domain_db.servernames and hconfigs[ConfigEnum.core_type] != "singbox":
+            base['sni'] = random.sample(re.split('[ \t\r\n;,]+', domain_db.servernames), 1)[0]
+
+    if 'password' in base:
+        if base['proto'] == 'trojan':
+            base['password'] = base['uuid']
+        else:
+            base['password'] = f'{hutils.encode.do_base_64(hconfigs[ConfigEnum.shared_secret].replace("-",""))}:{hutils.encode.do_base_64(account.uuid.replace("-",""))}'
+
+    if base.get('tls_mixed_case'):
+        base['host'] = hutils.random.random_case(base['host'])
+        base['sni'] = hutils.random.random_case(base['sni'])
+        base['server'] = hutils.random.random_case(base['server'])
+        if base.get('fakedomain'):
+            base['fakedomain'] = hutils.random.random_case(base['fakedomain'])
+        if base['transport'] in ['ws', 'httpupgrade', 'splithttp']:
+            # make_proxy sets the host of these transports to the domain after the mixed case
+            base['host'] = domain_db.domain
+
+    if 'private_key' in base:
+        base['private_key'] = account.ed25519_private_key
+    return base
+
+
+def make_proxy_template(hconfigs: dict, proxy: 'Proxy | ProxyRecord', domain_db: Domain, phttp=80, ptls=443, pport: int | None = None) -> dict:
+    '''
+    Returns the proxy without the user fields and the random choices (see add_user_to_proxy), or the reason it is not valid in msg.
+    It depends only on the configs, the domain and the proxy so it is reused for all the users.
+    '''
 
     l3 = proxy.l3
     domain = domain_db.domain
@@ -265,7 +355,7 @@ def make_proxy(hconfigs: dict, proxy: Proxy, domain_db: Domain, phttp=80, ptls=4
         'port': port,
         'server': cdn_forced_host,
         'sni': domain_db.servernames if is_cdn and domain_db.servernames else domain,
-        'uuid': str(g.account.uuid),
+        'uuid': None,
         'proto': proxy.proto,
         'transport': proxy.transport,
         'proxy_path': hconfigs[ConfigEnum.proxy_path],
@@ -273,8 +363,8 @@ def make_proxy(hconfigs: dict, proxy: Proxy, domain_db: Domain, phttp=80, ptls=4
         'extra_info': f'{domain_db.alias or domain}',
         'fingerprint': hconfigs[ConfigEnum.utls],
         'allow_insecure': domain_db.mode == DomainType.fake or "Fake" in proxy.cdn,
-        'dbe': proxy,
-        'dbdomain': domain_db
+        'dbe': None,
+        'dbdomain': None
     }
     if proxy.proto in ['tuic', 'hysteria2']:
         base['alpn'] = "h3"
@@ -285,11 +375,11 @@ def make_proxy(hconfigs: dict, proxy: Proxy, domain_db: Domain, phttp=80, ptls=4
             base['hysteria_obfs_password'] = hconfigs.get(ConfigEnum.proxy_path)  # TODO: it should not be correct
         return base
     if proxy.proto in ['wireguard']:
-        base['wg_pub'] = g.account.wg_pub
-        base['wg_pk'] = g.account.wg_pk
-        base['wg_psk'] = g.account.wg_psk
-        base['wg_ipv4'] = hutils.network.add_number_to_ipv4(hconfigs[ConfigEnum.wireguard_ipv4], g.account.id)
-        base['wg_ipv6'] = hutils.network.add_number_to_ipv6(hconfigs[ConfigEnum.wireguard_ipv6], g.account.id)
+        base['wg_pub'] = None
+        base['wg_pk'] = None
+        base['wg_psk'] = None
+        base['wg_ipv4'] = None
+        base['wg_ipv6'] = None
         base['wg_server_pub'] = hconfigs[ConfigEnum.wireguard_public_key]
         base['wg_noise_trick'] = hconfigs[ConfigEnum.wireguard_noise_trick]
         return base
@@ -298,14 +388,13 @@ def make_proxy(hconfigs: dict, proxy: Proxy, domain_db: Domain, phttp=80, ptls=4
         base['cipher'] = "auto"  # "chacha20-poly1305"
 
     if l3 in ['reality']:
-        base['reality_short_id'] = random.sample(hconfigs[ConfigEnum.reality_short_ids].split(','), 1)[0]
+        base['reality_short_id'] = None
         # base['flow']="xtls-rprx-vision"
         base['reality_pbk'] = hconfigs[ConfigEnum.reality_public_key]
         if (domain_db.servernames):
             all_servernames = re.split('[ \t\r\n;,]+', domain_db.servernames)
-            base['sni'] = random.sample(all_servernames, 1)[0]
-            if hconfigs[ConfigEnum.core_type] == "singbox":
-                base['sni'] = all_servernames[0]
+            # the other cores get a random one per request
+            base['sni'] = all_servernames[0]
         else:
             base['sni'] = domain_db.domain
 
@@ -339,10 +428,10 @@ def make_proxy(hconfigs: dict, proxy: Proxy, domain_db: Domain, phttp=80, ptls=4
 
     if base["proto"] in ['v2ray', 'ss', 'ssr']:
         base['cipher'] = hconfigs[ConfigEnum.shadowsocks2022_method]
-        base['password'] = f'{hutils.encode.do_base_64(hconfigs[ConfigEnum.shared_secret].replace("-",""))}:{hutils.encode.do_base_64(g.account.uuid.replace("-",""))}'
+        base['password'] = None
 
     if base['proto'] == 'trojan':
-        base['password'] = base['uuid']
+        base['password'] = None
     if base["proto"] == "ssr":
         base["ssr-obfs"] = "tls1.2_ticket_auth"
         base["ssr-protocol"] = "auth_sha1_v4"
@@ -388,11 +477,6 @@ def make_proxy(hconfigs: dict, proxy: Proxy, domain_db: Domain, phttp=80, ptls=4
 
         if hconfigs[ConfigEnum.tls_mixed_case]:
             base["tls_mixed_case"] = hconfigs[ConfigEnum.tls_mixed_case]
-            base['host'] = hutils.random.random_case(base['host'])
-            base['sni'] = hutils.random.random_case(base['sni'])
-            base['server'] = hutils.random.random_case(base['server'])
-            if base.get('fakedomain'):
-                base['fakedomain'] = hutils.random.random_case(base['fakedomain'])
 
         if hconfigs[ConfigEnum.tls_padding_enable]:
             base["tls_padding_enable"] = hconfigs[ConfigEnum.tls_padding_enable]
@@ -436,7 +520,7 @@ def make_proxy(hconfigs: dict, proxy: Proxy, domain_db: Domain, phttp=80, ptls=4
         base['alpn'] = 'http/1.1'
         return base
     if ProxyProto.ssh == proxy.proto:
-        base['private_key'] = g.account.ed25519_private_key
+        base['private_key'] = None
         base['host_keys'] = hutils.proxy.get_ssh_hostkeys(hconfigs,False)
         # base['ssh_port'] = hconfig(ConfigEnum.ssh_server_port)
         return base
@@ -1,15 +1,31 @@
 import json
-import copy
 from flask import render_template, g
 from hiddifypanel import hutils
-from hiddifypanel.models import ProxyTransport, ProxyL3, ProxyProto, Domain, User
+from hiddifypanel.models import ProxyTransport, ProxyL3, ProxyProto, Domain, User, Child
 from flask_babel import gettext as _
-from hiddifypanel.models import hconfig, ConfigEnum
+from hiddifypanel.models import hconfig, ConfigEnum, get_config_revision
 from .xray import is_muxable_agent, OUTBOUND_LEVEL
 
+MAX_BASE_CONFIGS = 64
+_base_configs = {}  # (child_id, config revision) -> parsed base_xray_config.json.j2
+
+
+def get_base_config() -> dict:
+    '''
+    Returns the parsed base config, it only depends on the configs of the child (the remarks are set by the caller).
+    It is shared by all the requests, so it must not be changed.
+    '''
+    key = (Child.current().id, get_config_revision())
+    base_config = _base_configs.get(key)
+    if base_config is None:
+        if len(_base_configs) >= MAX_BASE_CONFIGS:
+            _base_configs.clear()
+        base_config = _base_configs[key] = json.loads(render_template('base_xray_config.json.j2', remarks=''))
+    return base_config
+
 
-def configs_as_json(domains: list[Domain], user: User, expire_days: int, remarks: str) -> str:
-    '''Returns xray configs as json'''
+def configs_as_json(domains: list[Domain], user: User, expire_days: int, remarks: str, compact: bool = False) -> str:
+    '''Returns xray configs as json, without indentation if compact'''
     all_configs = []
 
     # region show usage
@@ -66,24 +82,20 @@ def configs_as_json(domains: list[Domain], user: User, expire_days: int, remarks
             outbound = to_xray(proxy)
             outbounds.append(outbound)
 
-        base_config = json.loads(render_template('base_xray_config.json.j2', remarks=remarks))
+        # the documents share everything but the remarks and the outbounds list with the base config
+        base_config = get_base_config()
         if len(outbounds) > 1:
             for out in outbounds:
-                base = copy.deepcopy(base_config)
-                base['remarks'] = out['tag']
-                base['outbounds'].insert(0, out)
-                # if all_configs:
-                #     all_configs.insert(0, copy.deepcopy(base_config))
-                # else:
-                all_configs.append(base)
+                all_configs.append({**base_config, 'remarks': out['tag'], 'outbounds': [out, *base_config['outbounds']]})
 
         else:  # single outbound
-            base_config['outbounds'].insert(0, outbounds[0])
-            all_configs = base_config
+            all_configs = {**base_config, 'remarks': remarks, 'outbounds': [*outbounds[:1], *base_config['outbounds']]}
 
     if not all_configs:
         return ''
 
+    if compact:
+        return json.dumps(all_configs, separators=(',', ':'), cls=hutils.proxy.ProxyJsonEncoder)
     json_configs = json.dumps(all_configs, indent=2, cls=hutils.proxy.ProxyJsonEncoder)
     return json_configs
 
@@ -1,13 +1,13 @@
 from .role import Role, AccountType
 from .child import Child, ChildMode
 from .config_enum import ConfigCategory, ConfigEnum, Lang, ApplyMode, PanelMode, LogLevel
-from .config import StrConfig, BoolConfig, get_hconfigs, hconfig, set_hconfig, add_or_update_config, bulk_register_configs, get_hconfigs_childs
+from .config import StrConfig, BoolConfig, get_hconfigs, hconfig, set_hconfig, add_or_update_config, bulk_register_configs, get_hconfigs_childs, get_config_revision, bump_config_revision
 
 # from .parent_domain import ParentDomain
 from .domain import Domain, DomainType, ShowDomain
 from .proxy import Proxy, ProxyL3, ProxyCDN, ProxyProto, ProxyTransport
-from .user import User, UserMode, UserDetail, ONE_GIG
+from .user import User, UserMode, UserDetail, ONE_GIG, bump_users_revision, get_users_revision
 from .admin import AdminUser, AdminMode
-from .usage import DailyUsage
+from .usage import DailyUsage, UsageStreamCursor
 from .base_account import BaseAccount
 # from .report import Report, ReportDetail
@@ -132,8 +132,9 @@ class AdminUser(BaseAccount, SerializerMixin):
         if users_count <= self.max_active_users:
             return True
 
-        actives = [u for u in self.recursive_users_query().all() if u.is_active]
-        return len(actives) <= self.max_active_users
+        from .user import User
+        actives = self.recursive_users_query().filter(User.is_active).count()
+        return actives <= self.max_active_users
 
     def recursive_sub_admins_ids(self, depth=20, seen=None):
         if seen is None:
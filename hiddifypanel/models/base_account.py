@@ -84,13 +84,16 @@ class BaseAccount(db.Model, SerializerMixin, FlaskLoginUserMixin):  # type: igno
         return db_account
 
     @classmethod
-    def bulk_register(cls, accounts: list = [], commit: bool = True, remove: bool = False):
+    def bulk_register(cls, accounts: list = [], commit: bool = True, remove: bool = False) -> list:
+        '''Returns the accounts that are removed because they are not in the accounts (only if remove is set)'''
         for u in accounts:
             cls.add_or_update(commit=False, **u)
+        removed = []
         if remove:
             dd = {str(u['uuid']): 1 for u in accounts}
-            for d in cls.query.all():
-                if d.uuid not in dd:
-                    db.session.delete(d)  # type: ignore
+            removed = [d for d in cls.query.all() if d.uuid not in dd]
+            for d in removed:
+                db.session.delete(d)  # type: ignore
         if commit:
             db.session.commit()  # type: ignore
+        return removed
@@ -1,12 +1,15 @@
 from typing import Optional
+from collections import defaultdict
+import time
 from hiddifypanel.models.config_enum import ConfigEnum, LogLevel, PanelMode, Lang
-from flask import g
+from flask import g, has_app_context
 
 from hiddifypanel import Events
 from hiddifypanel.database import db
-from hiddifypanel.cache import cache
+from hiddifypanel.cache import cache, redis_client, on_invalidation, publish_invalidation, ensure_invalidation_listener
 from hiddifypanel.models.child import Child, ChildMode
-from sqlalchemy import Column, String, Boolean, Enum, ForeignKey, Integer
+from sqlalchemy import Column, String, Boolean, Enum, ForeignKey, Integer, event
+from sqlalchemy.orm import Session
 from strenum import StrEnum
 from sqlalchemy_serializer import SerializerMixin
 from loguru import logger
@@ -58,11 +61,57 @@ class StrConfig(db.Model, SerializerMixin):
         return HConfigSchema().load(conf_dict)
 
 
-@cache.cache(ttl=500)
+HCONFIG_L1_TTL = 30  # seconds, it only bounds the staleness if an invalidation message is missed
+_hconfig_l1: dict[int, dict] = defaultdict(dict)  # child_id -> {(function name, *args): (expire time, value)}
+
+
+def _on_hconfig_invalidation(message: str):
+    # the message is a child id or * for all of them
+    if message == "*":
+        _hconfig_l1.clear()
+    elif message.isdecimal():
+        _hconfig_l1.pop(int(message), None)
+
+
+on_invalidation(_on_hconfig_invalidation)
+
+
+def _current_child_id() -> int:
+    if has_app_context() and hasattr(g, "child"):
+        return g.child.id
+    return Child.current().id
+
+
+def _l1_get(child_id: int, key: tuple, load):
+    ensure_invalidation_listener()
+    entries = _hconfig_l1[child_id]
+    now = time.monotonic()
+    entry = entries.get(key)
+    if entry and entry[0] > now:
+        return entry[1]
+    value = load()
+    entries[key] = (now + HCONFIG_L1_TTL, value)
+    return value
+
+
+def invalidate_hconfigs(child_id: int | None = None):
+    '''Drops the cached configs of the child (or all of them) in redis and in every process'''
+    _hconfig.invalidate_all()
+    _get_hconfigs.invalidate_all()
+    publish_invalidation("*" if child_id is None else str(child_id))
+
+
 def hconfig(key: ConfigEnum, child_id: Optional[int] = None):  # -> str | int | StrEnum | None:
+    '''
+    Returns the config, from the memory of this process, then redis and then the database.
+    '''
     if child_id is None:
-        child_id = Child.current().id
+        child_id = _current_child_id()
+    return _l1_get(child_id, ('hconfig', key), lambda: _hconfig(key, child_id))
+
 
+@cache.cache(ttl=500)
+def _hconfig(key: ConfigEnum, child_id: int):
     value = None
     try:
         if key.type == bool:
@@ -96,15 +145,9 @@ def set_hconfig(key: ConfigEnum, value: str | int | bool, child_id: int | None =
     if key.type == int and value != None:
         int(value)  # for testing int
 
-    # hconfig.invalidate(key, child_id)
-    # get_hconfigs.invalidate(child_id)
-    hconfig.invalidate(key, child_id)
-    hconfig.invalidate(key, child_id=child_id)
-    hconfig.invalidate(key=key, child_id=child_id)
-    if child_id == Child.current().id:
-        hconfig.invalidate(key)
-    # hconfig.invalidate_all()
-    get_hconfigs.invalidate_all()
+    _hconfig.invalidate(key, child_id)
+    _get_hconfigs.invalidate_all()
+    publish_invalidation(str(child_id))
     old_v = None
     if key.type == bool:
         dbconf = BoolConfig.query.filter(BoolConfig.key == key, BoolConfig.child_id == child_id).first()
@@ -133,11 +176,15 @@ def set_hconfig(key: ConfigEnum, value: str | int | bool, child_id: int | None =
         db.session.commit()
 
 
-@cache.cache(ttl=500,)
 def get_hconfigs(child_id: int | None = None, json=False) -> dict:
     if child_id is None:
-        child_id = Child.current().id
+        child_id = _current_child_id()
+    # a copy, the callers may change it
+    return dict(_l1_get(child_id, ('get_hconfigs', json), lambda: _get_hconfigs(child_id, json)))
+
 
+@cache.cache(ttl=500,)
+def _get_hconfigs(child_id: int, json=False) -> dict:
     return {**{f'{u.key}' if json else u.key: u.value for u in BoolConfig.query.filter(BoolConfig.child_id == child_id).all() if u.key.type == bool},
             **{f'{u.key}' if json else u.key: int(u.value) if u.key.type == int and u.value != None else u.value for u in StrConfig.query.filter(StrConfig.child_id == child_id).all() if u.key.type != bool},
             }
@@ -172,3 +219,49 @@ def bulk_register_configs(hconfigs, commit: bool = True, froce_child_unique_id:
         add_or_update_config(commit=False, child_id=child_id, **conf)
     if commit:
         db.session.commit()
+
+
+CONFIG_REVISION_KEY = "config:revision"  # incremented after every commit that changes the configs, domains, proxies or childs
+# the models that the generated client configs are made of, the users are keyed separately by the subscription cache
+CONFIG_REVISION_MODELS = {'BoolConfig', 'StrConfig', 'Domain', 'Proxy', 'Child'}
+
+
+def bump_config_revision():
+    '''
+    It is done after every commit that changes the revisioned models through the orm, the bulk_save_objects
+    callers (which skip the orm hooks) call it themselves after their commit.
+    '''
+    invalidate_hconfigs()
+    redis_client.incr(CONFIG_REVISION_KEY)
+
+
+def get_config_revision() -> int:
+    return int(redis_client.get(CONFIG_REVISION_KEY) or 0)
+
+
+@event.listens_for(Session, 'after_flush')
+def on_config_flush(session, flush_context):
+    for obj in (*session.new, *session.dirty, *session.deleted):
+        if type(obj).__name__ in CONFIG_REVISION_MODELS:
+            session.info['config_changed'] = True
+            return
+
+
+@event.listens_for(Session, 'do_orm_execute')
+def on_config_bulk_execute(orm_execute_state):
+    # query.update() and query.delete() do not flush the objects, so on_config_flush does not see them
+    if (orm_execute_state.is_update or orm_execute_state.is_delete) and \
+            any(mapper.class_.__name__ in CONFIG_REVISION_MODELS for mapper in orm_execute_state.all_mappers):
+        orm_execute_state.session.info['config_changed'] = True
+
+
+@event.listens_for(Session, 'after_commit')
+def on_config_commit(session):
+    if session.info.pop('config_changed', False):
+        # the other processes may have cached the old values between set_hconfig and the commit (see bump_config_revision)
+        bump_config_revision()
+
+
+@event.listens_for(Session, 'after_rollback')
+def on_config_rollback(session):
+    session.info.pop('config_changed', None)
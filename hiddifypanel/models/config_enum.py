@@ -250,7 +250,7 @@ class ConfigEnum(metaclass=FastEnum):
     h2_enable = _BoolConfigDscr(ConfigCategory.proxies, ApplyMode.apply_config)
 
     db_version = _StrConfigDscr(ConfigCategory.hidden)
-    last_priodic_usage_check = _IntConfigDscr(ConfigCategory.hidden)
+    last_priodic_usage_check = _IntConfigDscr(ConfigCategory.hidden)  # removed
 
     branding_title = _StrConfigDscr(ConfigCategory.branding)
     branding_site = _StrConfigDscr(ConfigCategory.branding)
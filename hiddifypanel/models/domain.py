@@ -4,7 +4,8 @@ import re
 from typing import Dict, List
 from flask import request
 from flask_babel import lazy_gettext as _
-from sqlalchemy.orm import backref
+from sqlalchemy import event
+from sqlalchemy.orm import backref, object_session, Session
 from strenum import StrEnum
 from sqlalchemy_serializer import SerializerMixin
 
@@ -207,3 +208,30 @@ class Domain(db.Model, SerializerMixin):
 
         if commit:
             db.session.commit()
+
+
+@event.listens_for(Domain, 'after_insert')
+@event.listens_for(Domain, 'after_update')
+def on_domain_change(mapper, connection, target):
+    if session := object_session(target):
+        session.info.setdefault('changed_domains', set()).add(target.domain)
+
+
+@event.listens_for(Domain, 'after_delete')
+def on_domain_delete(mapper, connection, target):
+    if session := object_session(target):
+        session.info.setdefault('changed_domains', set())
+
+
+@event.listens_for(Session, 'after_commit')
+def on_domain_commit(session):
+    # so the subscriptions find them resolved
+    if (domains := session.info.pop('changed_domains', None)) is not None:
+        from hiddifypanel import hutils
+        hutils.network.refresh_domains_ips(domains)
+        hutils.network.refresh_direct_host_or_ip()
+
+
+@event.listens_for(Session, 'after_rollback')
+def on_domain_rollback(session):
+    session.info.pop('changed_domains', None)
@@ -9,6 +9,21 @@ from hiddifypanel.database import db
 from sqlalchemy_serializer import SerializerMixin
 
 
+class UsageStreamCursor(db.Model):
+    '''The id of the last usage stream entry accounted into the database, it is committed with the usages'''
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    last_id = db.Column(db.String(64), default='0-0', nullable=False)
+
+    @staticmethod
+    def for_update(id=0) -> 'UsageStreamCursor':
+        '''Reads the cursor from the database (not from the session or any cache) and locks it until the commit'''
+        cursor = UsageStreamCursor.query.filter(UsageStreamCursor.id == id).populate_existing().with_for_update().first()
+        if cursor is None:
+            cursor = UsageStreamCursor(id=id, last_id='0-0')
+            db.session.add(cursor)
+        return cursor
+
+
 class DailyUsage(db.Model, SerializerMixin):
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     date = db.Column(db.Date, default=datetime.date.today(), index=True)
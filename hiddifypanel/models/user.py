@@ -5,14 +5,18 @@ from hiddifypanel.models.role import Role
 from dateutil import relativedelta
 
 from strenum import StrEnum
-from sqlalchemy import event
+from sqlalchemy import event, and_, or_
+from sqlalchemy.ext.hybrid import hybrid_property
+from sqlalchemy.orm import Session, object_session
 
 from hiddifypanel.database import db
+from hiddifypanel.cache import redis_client
 from hiddifypanel.models import Lang
 from hiddifypanel.models.base_account import BaseAccount
 from hiddifypanel.models.admin import AdminUser
 from sqlalchemy_serializer import SerializerMixin
 
+USERS_REVISION_KEY = "users:revision"  # incremented on every change of the users, see bump_users_revision
 ONE_GIG = 1024 * 1024 * 1024
 
 
@@ -65,7 +69,7 @@ class User(BaseAccount, SerializerMixin):
     account expiration date, usage limit, package days, mode, start date, current usage, last reset time, and comment.
     """
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
-    last_online = db.Column(db.DateTime, nullable=False, default=datetime.datetime.min)
+    last_online = db.Column(db.DateTime, nullable=False, default=datetime.datetime.min, index=True)
     # removed
     # expiry_time = db.Column(db.Date, default=datetime.date.today() + relativedelta.relativedelta(months=6))
     usage_limit = db.Column(db.BigInteger, default=1000 * ONE_GIG, nullable=False)
@@ -75,6 +79,8 @@ class User(BaseAccount, SerializerMixin):
     start_date = db.Column(db.Date, nullable=True)
     current_usage = db.Column(db.BigInteger, default=0, nullable=False)
     last_reset_time = db.Column(db.Date, default=datetime.date.today())
+    next_reset_date = db.Column(db.Date, nullable=True, index=True)
+    expires_on = db.Column(db.Date, nullable=True, index=True)
     added_by = db.Column(db.Integer, db.ForeignKey('admin_user.id'), default=1)
     max_ips = db.Column(db.Integer, default=1000, nullable=False)
     details = db.relationship('UserDetail', cascade="all,delete", backref='user', lazy='dynamic',)
@@ -108,7 +114,7 @@ class User(BaseAccount, SerializerMixin):
     def usage_limit_GB(self, value):
         self.usage_limit = min(1000000 * ONE_GIG, (value or 0) * ONE_GIG)
 
-    @property
+    @hybrid_property
     def is_active(self) -> bool:
         """
         The "is_active" function checks if the input user object "user" is active by verifying if their mode is not
@@ -128,6 +134,30 @@ class User(BaseAccount, SerializerMixin):
         #     is_active = False
         return is_active
 
+    @is_active.inplace.expression
+    @classmethod
+    def _is_active_expression(cls):
+        today = datetime.date.today()
+        return and_(
+            cls.enable == True,  # noqa: E712
+            cls.current_usage <= cls.usage_limit,
+            or_(cls.expires_on >= today, and_(cls.start_date.is_(None), cls.package_days >= 0))
+        )
+
+    @hybrid_property
+    def quota_exceeded(self) -> bool:
+        return self.usage_limit < self.current_usage
+
+    def calc_expires_on(self, start_date: datetime.date | None = None) -> datetime.date | None:
+        """
+        The "calc_expires_on" function returns the last day of the package, after it "remaining_days" is negative.
+        It is None while the package is not started yet.
+        """
+        start_date = start_date or self.start_date
+        if not start_date or self.package_days is None:
+            return None
+        return start_date + datetime.timedelta(days=self.package_days)
+
     @property
     def devices(self):
         res = {}
@@ -147,6 +177,22 @@ class User(BaseAccount, SerializerMixin):
             return False
         return ((datetime.date.today() - self.start_date).days % package_mode_dic.get(self.mode, 10000)) == 0
 
+    def calc_next_reset_date(self, start_date: datetime.date | None = None) -> datetime.date | None:
+        """
+        The "calc_next_reset_date" function returns the first day after the last reset in which
+        "user_should_reset" holds, so the periodic reset can be found with an indexed range query.
+        """
+        start_date = start_date or self.start_date
+        if self.mode not in package_mode_dic:
+            return None
+        if not self.last_reset_time:
+            return datetime.date.today()
+        if not start_date:
+            return None
+        period = package_mode_dic[self.mode]
+        first_day = self.last_reset_time + datetime.timedelta(days=1)
+        return first_day + datetime.timedelta(days=-(first_day - start_date).days % period)
+
     def reset_usage(self, commit: bool = False):
         '''Resets the user usages'''
         self.last_reset_time = datetime.date.today()
@@ -192,6 +238,16 @@ class User(BaseAccount, SerializerMixin):
             res = self.package_days
         return min(res, 10000)
 
+    @classmethod
+    def bulk_register(cls, accounts: list = [], commit: bool = True, remove: bool = False) -> list:
+        removed = super().bulk_register(accounts, commit=False, remove=remove)
+        if removed:
+            # they are removed from the drivers once the deletion is committed (on_session_transaction_end)
+            db.session.info.setdefault('removed_users', []).extend(removed)
+        if commit:
+            db.session.commit()
+        return removed
+
     def remove(self, commit=True) -> None:
         from hiddifypanel.drivers import user_driver
         user_driver.remove_client(self)
@@ -350,3 +406,56 @@ def on_user_insert(mapper, connection, target):
     hutils.model.gen_password(target)
     hutils.model.gen_ed25519_keys(target)
     hutils.model.gen_wg_keys(target)
+    if target.last_reset_time is None:
+        target.last_reset_time = datetime.date.today()
+    target.next_reset_date = target.calc_next_reset_date()
+    target.expires_on = target.calc_expires_on()
+
+
+@event.listens_for(User, 'before_update')
+def on_user_update(mapper, connection, target):
+    target.next_reset_date = target.calc_next_reset_date()
+    target.expires_on = target.calc_expires_on()
+
+
+def bump_users_revision():
+    '''
+    Marks the users as changed for the incremental apply (hiddify.all_configs_for_cli),
+    the bulk sql updates that change which users are active should call it too.
+    '''
+    redis_client.incr(USERS_REVISION_KEY)
+
+
+def get_users_revision() -> int:
+    return int(redis_client.get(USERS_REVISION_KEY) or 0)
+
+
+@event.listens_for(User, 'after_insert')
+@event.listens_for(User, 'after_update')
+@event.listens_for(User, 'after_delete')
+def on_user_change(mapper, connection, target):
+    # bumped after the commit, otherwise an export in between would record the new revision with the old users
+    if session := object_session(target):
+        session.info['users_changed'] = True
+
+
+@event.listens_for(Session, 'after_commit')
+def on_session_commit(session):
+    if session.info.pop('users_changed', False):
+        bump_users_revision()
+    if 'removed_users' in session.info:
+        session.info['committed_removed_users'] = session.info.pop('removed_users')
+
+
+@event.listens_for(Session, 'after_transaction_end')
+def on_session_transaction_end(session, transaction):
+    # not in after_commit, the session can not run the queries of the drivers (e.g. their configs) there
+    if transaction.parent is None and (removed := session.info.pop('committed_removed_users', None)):
+        from hiddifypanel.drivers import user_driver
+        user_driver.remove_clients(removed)
+
+
+@event.listens_for(Session, 'after_rollback')
+def on_session_rollback(session):
+    session.info.pop('users_changed', None)
+    session.info.pop('removed_users', None)
@@ -37,18 +37,17 @@ class Actions(FlaskView):
 
     @login_required(roles={Role.super_admin})
     def reset2(self):
-        res = render_template("result.html",
-                              out_type="info",
-                              out_msg="",
-                              log_file_url=get_log_api_url(),
-                              log_file='restart.log',
-                              show_success=True,
-                              domains=get_domains())
-
         # run restart.sh
-        commander(Command.restart_services)
+        job_id = commander(Command.restart_services)
 
-        return res
+        return render_template("result.html",
+                               out_type="info",
+                               out_msg="",
+                               log_file_url=get_log_api_url(),
+                               log_file='restart.log',
+                               job_url=get_job_api_url(job_id),
+                               show_success=True,
+                               domains=get_domains())
 
     @login_required(roles={Role.super_admin})
     @route('reinstall', methods=['POST'])
@@ -85,24 +84,23 @@ class Actions(FlaskView):
             link = hiddify.get_account_panel_link(g.account, d)
             admin_links += f"<li><a target='_blank' class='badge ltr' href='{link}'>{link}</a></li>"
 
-        resp = render_template("result.html",
+        # subprocess.Popen(f"sudo {config['HIDDIFY_CONFIG_PATH']}/{file} --no-gui".split(" "), cwd=f"{config['HIDDIFY_CONFIG_PATH']}", start_new_session=True)
+
+        # run install.sh or apply_configs.sh
+        job_id = commander(Command.install if complete_install else Command.apply)
+
+        # import time
+        # time.sleep(1)
+        return render_template("result.html",
                                out_type="info",
                                out_msg=_("admin.waiting_for_update") +
                                admin_links,
                                log_file_url=get_log_api_url(),
                                log_file="0-install.log",
+                               job_url=get_job_api_url(job_id),
                                show_success=True,
                                domains=get_domains())
 
-        # subprocess.Popen(f"sudo {config['HIDDIFY_CONFIG_PATH']}/{file} --no-gui".split(" "), cwd=f"{config['HIDDIFY_CONFIG_PATH']}", start_new_session=True)
-
-        # run install.sh or apply_configs.sh
-        commander(Command.install if complete_install else Command.apply)
-
-        # import time
-        # time.sleep(1)
-        return resp
-
     @login_required(roles={Role.super_admin})
     def change_reality_keys(self):
         key = hutils.crypto.generate_x25519_keys()
@@ -114,12 +112,13 @@ class Actions(FlaskView):
     @ login_required(roles={Role.super_admin})
     def status(self):
         # run status.sh
-        commander(Command.status)
+        job_id = commander(Command.status)
         return render_template("result.html",
                                out_type="info",
                                out_msg=_("see the log in the bellow screen"),
                                log_file_url=get_log_api_url(),
                                log_file="status.log",
+                               job_url=get_job_api_url(job_id),
                                show_success=False,
                                domains=get_domains())
 
@@ -132,7 +131,7 @@ class Actions(FlaskView):
         # hiddify.add_temporary_access()
         # run update.sh
 
-        commander(Command.update)
+        job_id = commander(Command.update)
 
         return render_template("result.html",
                                out_type="success",
@@ -140,6 +139,7 @@ class Actions(FlaskView):
                                show_success=True,
                                log_file_url=get_log_api_url(),
                                log_file="update.log",
+                               job_url=get_job_api_url(job_id),
                                domains=get_domains())
 
     def get_some_random_reality_friendly_domain(self):
@@ -191,5 +191,9 @@ def get_log_api_url():
     return f'/{g.get("new_proxy_path",g.proxy_path)}/api/v2/admin/log/'
 
 
+def get_job_api_url(job_id: str | None):
+    return f'/{g.get("new_proxy_path",g.proxy_path)}/api/v2/admin/job/{job_id}/' if job_id else None
+
+
 def get_domains():
     return [str(d.domain).replace("*", hutils.random.get_random_string(3, 6)) for d in Domain.get_domains(always_add_all_domains=True, always_add_ip=False)]
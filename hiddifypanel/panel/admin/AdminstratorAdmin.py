@@ -144,8 +144,7 @@ class AdminstratorAdmin(AdminLTEModelView):
 
     def _max_active_users_formatter(view, context, model, name):
 
-        actives = [u for u in model.recursive_users_query().all() if u.is_active]
-        u = len(actives)
+        u = model.recursive_users_query().filter(User.is_active).count()
         if model.mode == AdminMode.super_admin:
             return f"{u} / ∞"
         t = model.max_active_users
@@ -17,6 +17,7 @@ from .adminlte import AdminLTEModelView
 from hiddifypanel import hutils
 
 from flask import current_app
+from loguru import logger
 # Define a custom field type for the related domains
 
 
@@ -241,11 +242,11 @@ class DomainAdmin(AdminLTEModelView):
         if model.mode == DomainType.old_xtls_direct:
             if not hconfig(ConfigEnum.xtls_enable):
                 set_hconfig(ConfigEnum.xtls_enable, True)
-                hutils.proxy.get_proxies().invalidate_all()
+                hutils.proxy.get_proxies.invalidate_all()
         elif model.mode == DomainType.reality:
             if not hconfig(ConfigEnum.reality_enable):
                 set_hconfig(ConfigEnum.reality_enable, True)
-                hutils.proxy.get_proxies().invalidate_all()
+                hutils.proxy.get_proxies.invalidate_all()
             model.servernames = (model.servernames or model.domain).lower()
             for v in set([model.domain, model.servernames]):
                 for d in v.split(","):
@@ -300,7 +301,8 @@ class DomainAdmin(AdminLTEModelView):
         if hconfig(ConfigEnum.first_setup):
             set_hconfig(ConfigEnum.first_setup, False)
         if model.need_valid_ssl and "*" not in model.domain:
-            commander(Command.get_cert, domain=model.domain)
+            job_id = commander(Command.get_cert, domain=model.domain)
+            logger.info(f'getting the certificate of {model.domain} in commander job {job_id}')
         if hutils.node.is_child():
             hutils.node.run_node_op_in_bg(hutils.node.child.sync_with_parent, *[hutils.node.child.SyncFields.domains])
 
@@ -79,5 +79,7 @@ class NodeAdmin(AdminLTEModelView):
 
             db.session.bulk_save_objects(items_to_dup)
             db.session.commit()
+            # the bulk save skips the orm hooks that bump it
+            bump_config_revision()
             set_hconfig(ConfigEnum.is_parent, False, model.id)
             set_hconfig(ConfigEnum.parent_panel, hiddify.get_account_panel_link(g.account, request.host), model.id)
@@ -27,7 +27,7 @@ from hiddifypanel import hutils
 class UserAdmin(AdminLTEModelView):
     column_default_sort = ('id', False)  # Sort by username in ascending order
 
-    column_sortable_list = ["is_active", "name", "current_usage", 'mode', "remaining_days", "comment", 'last_online', "uuid", 'remaining_days']
+    column_sortable_list = ["is_active", "name", "current_usage", 'mode', ("remaining_days", "expires_on"), "comment", 'last_online', "uuid"]
     column_searchable_list = ["uuid", "name"]
     column_list = ["is_active", "name", "UserLinks", "current_usage", "remaining_days", "comment", 'last_online', 'mode', 'admin', "uuid"]
     column_editable_list = ["comment", "name", "uuid"]
@@ -79,6 +79,9 @@ class UserAdmin(AdminLTEModelView):
     }
     # column_labels={'uuid':_("user.UUID")}
     # column_filters=["usage_limit_GB","current_usage_GB",'admin','is_active']
+    column_filters = [custom_widgets.HybridBooleanFilter(User, 'is_active', _('Active')),
+                      custom_widgets.HybridBooleanFilter(User, 'quota_exceeded', _('Quota Exceeded')),
+                      'expires_on']
 
     column_labels = {
         "Actions": _("actions"),
@@ -99,6 +102,7 @@ class UserAdmin(AdminLTEModelView):
         "max_ips": _('Max IPs'),
         "enable": _('Enable'),
         "is_active": _('Active'),
+        "expires_on": _('Expires On'),
 
     }
     # can_set_page_size=True
@@ -323,30 +327,15 @@ class UserAdmin(AdminLTEModelView):
         if hutils.node.is_parent():
             hutils.node.run_node_op_in_bg(hutils.node.parent.request_childs_to_sync)
 
+    def _apply_sorting(self, query, joins, sort_column, sort_desc):
+        if sort_column == 'is_active':
+            # its sql expression depends on today, so the one scaffolded from column_sortable_list is not used
+            return self._order_by(query, joins, self._sortable_joins.get(sort_column), User.is_active, sort_desc)
+        return super()._apply_sorting(query, joins, sort_column, sort_desc)
+
     def get_list(self, page, sort_column, sort_desc, search, filters, page_size=50, *args, **kwargs):
-        res = None
         self._auto_joins = {}
-        # print('aaa',args, kwargs)
-        if sort_column in ['remaining_days', 'is_active']:
-            query = self.get_query()
-
-            if search:
-                from sqlalchemy import or_
-                search_conditions = or_(self.model.name.contains(search), self.model.uuid == search)
-                query = query.filter(search_conditions)
-
-            data = query.all()
-            count = len(data)
-            data = sorted(data, key=lambda p: getattr(p, sort_column), reverse=sort_desc)
-
-            # Applying pagination
-            start = page * page_size
-            end = start + page_size
-            data = data[start: end]
-            res = count, data
-        else:
-            res = super().get_list(page, sort_column, sort_desc, search=search, filters=filters, page_size=page_size, *args, **kwargs)
-        return res
+        return super().get_list(page, sort_column, sort_desc, search=search, filters=filters, page_size=page_size, *args, **kwargs)
 
         # Override the default get_list method to use the custom sort function
         # query = self.session.query(self.model)
@@ -2,6 +2,7 @@ import datetime
 import uuid
 import json
 import os
+import sys
 import click
 from dateutil import relativedelta
 
@@ -47,8 +48,9 @@ def backup():
                 bot.send_document(admin.telegram_id, document, visible_file_name=dst.replace("backup/", ""), caption=caption[:min(len(caption), 1000)])
 
 
-def all_configs():
-    print(json.dumps(hiddify.all_configs_for_cli(), indent=4))
+@click.option("--incremental", "-i", is_flag=True, help="Only the users changed since the last export, or all of them if there is no previous export")
+def all_configs(incremental):
+    hiddify.write_json_stream(hiddify.all_configs_for_cli(incremental=incremental, stream=True, record=incremental), sys.stdout)
 
 
 def update_usage():
@@ -192,6 +194,8 @@ def init_app(app):
         if len(data):
             db.session.bulk_save_objects(data)
         db.session.commit()
+        # the bulk save skips the orm hooks that bump it
+        bump_config_revision()
 
     @ app.cli.command()
     @ click.option("--xui_db_path", "-x")
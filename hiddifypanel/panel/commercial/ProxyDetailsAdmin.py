@@ -29,6 +29,9 @@ class ProxyDetailsAdmin(AdminLTEModelView):
         from hiddifypanel.database import db
         db.session.bulk_save_objects(get_proxy_rows_v1())
         db.session.commit()
+        # the bulk save skips the orm hooks that bump it
+        bump_config_revision()
+        hutils.proxy.get_proxies.invalidate_all()
         hutils.flask.flash((_('config.validation-success-no-reset')), 'success')  # type: ignore
         return redirect("./")
 
@@ -38,6 +41,7 @@ class ProxyDetailsAdmin(AdminLTEModelView):
         count = query.update({'enable': False})
 
         self.session.commit()
+        bump_config_revision()
         hutils.flask.flash(_('%(count)s records were successfully disabled.', count=count), 'success')
         hutils.proxy.get_proxies.invalidate_all()
 
@@ -47,6 +51,7 @@ class ProxyDetailsAdmin(AdminLTEModelView):
         count = query.update({'enable': True})
 
         self.session.commit()
+        bump_config_revision()
         hutils.flask.flash(_('%(count)s records were successfully enabled.', count=count), 'success')
         hutils.proxy.get_proxies.invalidate_all()
 
@@ -57,16 +57,16 @@ class SendMsgResource(Resource):
         if identifier == 'all':
             return query.all()
         if identifier == 'expired':
-            return [u for u in query.all() if not u.is_active]
+            return query.filter(~User.is_active).all()
         if identifier == 'active':
-            return [u for u in query.all() if u.is_active]
+            return query.filter(User.is_active).all()
         if identifier == 'offline 1h':
             h1 = datetime.datetime.now() - datetime.timedelta(hours=1)
-            return [u for u in query.all() if u.is_active and u.last_online < h1]
+            return query.filter(User.is_active, User.last_online < h1).all()
         if identifier == 'offline 1d':
             d1 = datetime.datetime.now() - datetime.timedelta(hours=24)
-            return [u for u in query.all() if u.is_active and u.last_online < d1]
+            return query.filter(User.is_active, User.last_online < d1).all()
         if identifier == 'offline 1w':
             d7 = datetime.datetime.now() - datetime.timedelta(days=7)
-            return [u for u in query.all() if u.is_active and u.last_online < d7]
+            return query.filter(User.is_active, User.last_online < d7).all()
         return []
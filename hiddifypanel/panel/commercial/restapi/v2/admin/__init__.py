@@ -14,6 +14,7 @@ def init_app(app):
         from .admin_users_api import AdminUsersApi
         from .admin_log_api import AdminLogApi
         from .system_actions import UpdateUserUsageApi, AllConfigsApi
+        from .job_api import JobApi
         bp.add_url_rule('/me/', view_func=AdminInfoApi)  # type: ignore
         bp.add_url_rule('/server_status/', view_func=AdminServerStatusApi)  # type: ignore
         bp.add_url_rule('/admin_user/<uuid:uuid>/', view_func=AdminUserApi)  # type: ignore
@@ -21,6 +22,7 @@ def init_app(app):
         bp.add_url_rule('/log/', view_func=AdminLogApi)  # type: ignore
         bp.add_url_rule('/update_user_usage/', view_func=UpdateUserUsageApi)  # type: ignore
         bp.add_url_rule('/all-configs/', view_func=AllConfigsApi)  # type: ignore
+        bp.add_url_rule('/job/<job_id>/', view_func=JobApi)  # type: ignore
         from .user_api import UserApi
         from .users_api import UsersApi
         bp.add_url_rule('/user/<uuid:uuid>/', view_func=UserApi)  # type: ignore
@@ -0,0 +1,30 @@
+from apiflask import Schema, fields, abort
+from flask.views import MethodView
+from flask import current_app as app
+from hiddifypanel.auth import login_required
+from hiddifypanel.models import Role
+from hiddifypanel.panel.run_commander import get_job
+
+
+class JobInputSchema(Schema):
+    offset = fields.Integer(load_default=0, description="The byte offset of the output to return from, pass the offset of the previous response to follow the output")
+
+
+class JobSchema(Schema):
+    id = fields.String(description="The job id")
+    command = fields.String(description="The commander command of the job")
+    status = fields.String(description="queued, running, finished, failed or unknown (its process is gone and its returncode is not known)")
+    returncode = fields.Integer(allow_none=True, description="The exit code of the command when it is finished")
+    output = fields.String(description="The output of the command from the requested offset")
+    offset = fields.Integer(description="The offset of the end of the returned output")
+
+
+class JobApi(MethodView):
+    decorators = [login_required({Role.super_admin})]
+
+    @app.input(JobInputSchema, arg_name="data", location='query')  # type: ignore
+    @app.output(JobSchema)  # type: ignore
+    def get(self, job_id: str, data: dict):
+        """System: Status and output of a commander job"""
+        job = get_job(job_id, offset=max(0, data.get('offset') or 0)) or abort(404, "Job not found")
+        return job
@@ -24,4 +24,5 @@ class AllConfigsApi(MethodView):
 
     def get(self):
         """System: All Configs for configuration"""
-        return json.dumps(hiddify.all_configs_for_cli(), indent=2)
+        incremental = request.args.get('incremental', '').lower() == 'true'
+        return json.dumps(hiddify.all_configs_for_cli(incremental=incremental), indent=2)
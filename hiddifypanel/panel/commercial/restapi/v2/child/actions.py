@@ -14,8 +14,8 @@ class Status(MethodView):
 
     def post(self):
         logger.info(f"Status action called by parent: {Child.node.unique_id}")
-        commander(Command.status)
-        return {'status': 200, 'msg': 'ok'}
+        job_id = commander(Command.status)
+        return {'status': 200, 'msg': 'ok', 'job_id': job_id}
 
 
 class UpdateUsage(MethodView):
@@ -23,8 +23,8 @@ class UpdateUsage(MethodView):
 
     def post(self):
         logger.info(f"Update usage action called by parent: {Child.node.unique_id}")
-        commander(Command.update_usage)
-        return {'status': 200, 'msg': 'ok'}
+        job_id = commander(Command.update_usage)
+        return {'status': 200, 'msg': 'ok', 'job_id': job_id}
 
 
 class Restart(MethodView):
@@ -32,8 +32,8 @@ class Restart(MethodView):
 
     def post(self):
         logger.info(f"Restart action called by parent: {Child.node.unique_id}")
-        commander(Command.restart_services)
-        return {'status': 200, 'msg': 'ok'}
+        job_id = commander(Command.restart_services)
+        return {'status': 200, 'msg': 'ok', 'job_id': job_id}
 
 
 class ApplyConfig(MethodView):
@@ -41,8 +41,8 @@ class ApplyConfig(MethodView):
 
     def post(self):
         logger.info(f"Apply config action called by parent: {Child.node.unique_id}")
-        commander(Command.apply)
-        return {'status': 200, 'msg': 'ok'}
+        job_id = commander(Command.apply)
+        return {'status': 200, 'msg': 'ok', 'job_id': job_id}
 
 
 class InstallSchema(Schema):
@@ -56,8 +56,8 @@ class Install(MethodView):
     def post(self, data: dict):
         if data.get('full'):
             logger.info(f"Install action called by parent: {Child.node.unique_id}, full=True")
-            commander(Command.install)
+            job_id = commander(Command.install)
         else:
             logger.info(f"Install action called by parent: {Child.node.unique_id}, full=False")
-            commander(Command.apply)
-        return {'status': 200, 'msg': 'ok'}
+            job_id = commander(Command.apply)
+        return {'status': 200, 'msg': 'ok', 'job_id': job_id}
@@ -1,6 +1,7 @@
 import datetime
 
 from flask_admin.contrib.sqla import ModelView
+from flask_admin.contrib.sqla.filters import BooleanEqualFilter
 from flask_babel import lazy_gettext as _
 from wtforms import TextAreaField
 from wtforms.fields import IntegerField, SelectField, DecimalField
@@ -89,3 +90,14 @@ class UsageField(DecimalField):
             self.data = int(float(valuelist[0]) * ONE_GIG)
         else:
             self.data = None
+
+
+class HybridBooleanFilter(BooleanEqualFilter):
+    # the sql expression of a hybrid property may depend on today, so it is rebuilt on each query
+    def __init__(self, model, attr, name):
+        super().__init__(getattr(model, attr), name)
+        self.model = model
+        self.attr = attr
+
+    def apply(self, query, value, alias=None):
+        return query.filter(getattr(self.model, self.attr) == bool(int(value)))
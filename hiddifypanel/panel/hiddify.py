@@ -1,18 +1,25 @@
 import re
+import json
+import types
+import hashlib
 import subprocess
+import threading
+import time
 
 from datetime import datetime
 from typing import Tuple
 from flask import current_app, g
 from flask_babel import lazy_gettext as _
+from sqlalchemy.orm import joinedload
 from datetime import timedelta
 
-from hiddifypanel.cache import cache
+from hiddifypanel.cache import cache, redis_client
 from hiddifypanel.models import *
 from hiddifypanel.database import db
 from hiddifypanel.hutils.utils import *
 from hiddifypanel import hutils
-from hiddifypanel.panel.run_commander import commander, Command
+from hiddifypanel.panel.run_commander import commander, Command, JobStatus, wait_job
+from loguru import logger
 import subprocess
 to_gig_d = 1000 * 1000 * 1000
 
@@ -62,13 +69,83 @@ def exec_command(cmd, cwd=None):
         print(e)
 
 
+APPLY_USERS_DIRTY_KEY = "apply-users:dirty"  # incremented on each apply request
+APPLY_USERS_WORKER_KEY = "apply-users:worker"  # held by the thread that runs the applies
+APPLY_USERS_WORKER_TTL = 30  # seconds, the worker refreshes it so a dead worker blocks the applies only that long
+APPLY_USERS_TIMEOUT = 600  # seconds that the worker waits for an apply job
+# releases the worker only if nothing is requested since its last apply, otherwise the requester would miss it
+RELEASE_APPLY_USERS_WORKER_SCRIPT = redis_client.register_script("""
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    redis.call('DEL', KEYS[2])
+    return 1
+end
+return 0
+""")
+
+
 def quick_apply_users():
-    # run install.sh apply_users
-    commander(Command.apply_users)
+    '''
+    Requests an apply of the users, the requests are coalesced so at most one apply runs
+    per APPLY_USERS_DEBOUNCE seconds (app.cfg, default 2) and the last one sees the latest state.
+    '''
+    window = float(current_app.config.get('APPLY_USERS_DEBOUNCE', 2))
+    redis_client.incr(APPLY_USERS_DIRTY_KEY)
+    if redis_client.set(APPLY_USERS_WORKER_KEY, "locked", nx=True, ex=APPLY_USERS_WORKER_TTL):
+        generation = redis_client.get(APPLY_USERS_DIRTY_KEY)
+        requested = time.time()
+        # submitted here, so it runs even if the process (e.g. the cli) exits right after
+        job_id = _apply_users()
+        app = current_app._get_current_object()  # type: ignore
+        # a daemon, so it does not keep a cli process alive, the lock expires soon after it is gone
+        threading.Thread(target=_apply_users_worker, args=(app, window, job_id, generation, requested), daemon=True).start()
 
     return {"status": 'success'}
 
 
+def _apply_users_worker(app, window: float, job_id: str | None, generation, requested: float):
+    with app.app_context():
+        try:
+            while True:
+                job = _wait_apply_users(job_id)
+                _on_apply_users_done()
+                # an apply that was already running is returned instead of a new one, it may miss the latest state
+                if not job or float(job['created']) >= requested:
+                    if job and job['status'] == JobStatus.finished and job.get('returncode') == '0':
+                        ack_users_export()
+                    redis_client.expire(APPLY_USERS_WORKER_KEY, int(window) + APPLY_USERS_WORKER_TTL)
+                    time.sleep(window)
+                    if RELEASE_APPLY_USERS_WORKER_SCRIPT(keys=[APPLY_USERS_DIRTY_KEY, APPLY_USERS_WORKER_KEY], args=[generation]):
+                        return
+                redis_client.expire(APPLY_USERS_WORKER_KEY, APPLY_USERS_WORKER_TTL)
+                generation = redis_client.get(APPLY_USERS_DIRTY_KEY)
+                requested = time.time()
+                job_id = _apply_users()
+        except Exception as e:
+            redis_client.delete(APPLY_USERS_WORKER_KEY)
+            logger.opt(exception=e).error(f'ERROR! apply users failed {e}')
+
+
+def _wait_apply_users(job_id: str | None) -> dict | None:
+    '''Waits for the apply job, the worker lock is refreshed meanwhile (heartbeat)'''
+    deadline = time.monotonic() + APPLY_USERS_TIMEOUT
+    while True:
+        redis_client.expire(APPLY_USERS_WORKER_KEY, APPLY_USERS_WORKER_TTL)
+        job = wait_job(job_id, timeout=APPLY_USERS_WORKER_TTL / 3) if job_id else None
+        if not job or job['status'] not in (JobStatus.queued, JobStatus.running) or time.monotonic() >= deadline:
+            return job
+
+
+def _apply_users():
+    # run install.sh apply_users
+    return commander(Command.apply_users)
+
+
+def _on_apply_users_done():
+    from hiddifypanel.drivers import xray_api
+    # the inbounds may be changed by the apply, the ones cached while it was running are the old ones
+    xray_api.invalidate_inbound_tags()
+
+
 # Importing socket library
 
 # Function to display hostname and
@@ -341,17 +418,138 @@ def get_backup_child_unique_id(backupdata: dict) -> str:
     return backupdata['childs'][0]['unique_id']
 
 
-def all_configs_for_cli():
-    valid_users = [u.to_dict(dump_id=True) for u in User.query.filter((User.usage_limit > User.current_usage)).all() if u.is_active]
+EXPORTED_USERS_KEY = "apply-users:exported"  # uuid -> digest of the user as it was last applied
+EXPORTED_USERS_REVISION_KEY = "apply-users:exported-revision"  # the users revision of the last applied export
+# an export that waits for its apply to succeed (ack_users_export) before it becomes the baseline of the next one
+PENDING_EXPORT_KEY = "apply-users:pending"  # the export meta as json, it is set once the export is fully written
+PENDING_EXPORT_USERS_KEY = "apply-users:pending-users"  # uuid -> digest of the changed users
+PENDING_EXPORT_REMOVED_KEY = "apply-users:pending-removed"  # the set of the removed uuids
+PENDING_EXPORT_TTL = 3600
+# these change on every usage update but not the applied configs
+UNAPPLIED_USER_FIELDS = ('last_online', 'current_usage_GB')
+
+
+def _user_digest(user: dict) -> str:
+    applied = {k: v for k, v in user.items() if k not in UNAPPLIED_USER_FIELDS}
+    return hashlib.sha1(json.dumps(applied, sort_keys=True, default=str).encode()).hexdigest()
+
+
+EXPORT_CHUNK_SIZE = 1000
+
+
+def iter_valid_users():
+    '''
+    Yields the users to apply as dicts, they are filtered in sql and loaded in chunks so the memory stays flat.
+    The chunks are pages on the id (not a streamed cursor, which mysql can not share with other queries),
+    and the admins are loaded with the users as to_dict reads them.
+    '''
+    query = User.query.filter(User.usage_limit > User.current_usage, User.is_active).options(joinedload(User.admin)).order_by(User.id)
+    last_id = 0
+    while users := query.filter(User.id > last_id).limit(EXPORT_CHUNK_SIZE).all():
+        for user in users:
+            yield user.to_dict(dump_id=True)
+            db.session.expunge(user)
+        last_id = users[-1].id
+
+
+def export_users(incremental: bool = False, record: bool = False) -> dict:
+    '''
+    Returns the valid users to apply, users and removed_users are generators to be consumed in order.
+    In incremental mode only the users added or changed since the last applied export are yielded in users,
+    and then the removed ones in removed_users. It falls back to a full export if there is no applied export.
+    If record is set (only for the incremental apply), the export is kept as pending while it is consumed,
+    and it becomes the baseline of the next incremental export only when ack_users_export is called after the apply.
+    '''
+    if record:
+        redis_client.delete(PENDING_EXPORT_KEY, PENDING_EXPORT_USERS_KEY, PENDING_EXPORT_REMOVED_KEY)
+    revision = get_users_revision()
+    exported_revision = redis_client.get(EXPORTED_USERS_REVISION_KEY)
+    incremental = incremental and exported_revision is not None
+    if incremental and int(exported_revision) == revision:
+        return {"incremental": True, "revision": revision, "users": iter([]), "removed_users": iter([])}
+
+    exported = {k.decode(): v.decode() for k, v in redis_client.hgetall(EXPORTED_USERS_KEY).items()} if incremental else {}
+    seen = set()
+
+    def record_changed(changed: dict):
+        with redis_client.pipeline() as pipe:
+            pipe.hset(PENDING_EXPORT_USERS_KEY, mapping=changed)
+            pipe.expire(PENDING_EXPORT_USERS_KEY, PENDING_EXPORT_TTL)
+            pipe.execute()
+
+    def users():
+        changed = {}
+        for user in iter_valid_users():
+            seen.add(user['uuid'])
+            digest = _user_digest(user)
+            if exported.get(user['uuid']) == digest:
+                continue
+            changed[user['uuid']] = digest
+            yield user
+            if record and len(changed) >= EXPORT_CHUNK_SIZE:
+                record_changed(changed)
+                changed = {}
+        if record and changed:
+            record_changed(changed)
+
+    def removed_users():
+        removed = [uuid for uuid in exported if uuid not in seen]
+        yield from removed
+        if not record:
+            return
+        with redis_client.pipeline() as pipe:
+            if removed:
+                pipe.sadd(PENDING_EXPORT_REMOVED_KEY, *removed)
+                pipe.expire(PENDING_EXPORT_REMOVED_KEY, PENDING_EXPORT_TTL)
+            pipe.set(PENDING_EXPORT_KEY, json.dumps({'revision': revision, 'incremental': incremental}), ex=PENDING_EXPORT_TTL)
+            pipe.execute()
+
+    return {"incremental": incremental, "revision": revision, "users": users(), "removed_users": removed_users()}
+
+
+def ack_users_export() -> bool:
+    '''
+    Makes the pending export (see export_users) the baseline of the next incremental export, it is called once its apply succeeded.
+    Returns False if there is no complete pending export.
+    '''
+    pending = redis_client.get(PENDING_EXPORT_KEY)
+    if pending is None:
+        return False
+    pending = json.loads(pending)
+    changed = {k.decode(): v.decode() for k, v in redis_client.hgetall(PENDING_EXPORT_USERS_KEY).items()}
+    removed = [uuid.decode() for uuid in redis_client.smembers(PENDING_EXPORT_REMOVED_KEY)]
+    with redis_client.pipeline() as pipe:
+        if not pending['incremental']:
+            # it was a full export, so the users that are not in it are not applied anymore
+            pipe.delete(EXPORTED_USERS_KEY)
+        for i in range(0, len(removed), EXPORT_CHUNK_SIZE):
+            pipe.hdel(EXPORTED_USERS_KEY, *removed[i:i + EXPORT_CHUNK_SIZE])
+        items = list(changed.items())
+        for i in range(0, len(items), EXPORT_CHUNK_SIZE):
+            pipe.hset(EXPORTED_USERS_KEY, mapping=dict(items[i:i + EXPORT_CHUNK_SIZE]))
+        pipe.set(EXPORTED_USERS_REVISION_KEY, pending['revision'])
+        pipe.delete(PENDING_EXPORT_KEY, PENDING_EXPORT_USERS_KEY, PENDING_EXPORT_REMOVED_KEY)
+        pipe.execute()
+    return True
+
+
+def all_configs_for_cli(incremental: bool = False, stream: bool = False, record: bool = False):
+    '''
+    If stream is set, users and removed_users are left as generators (see export_users and write_json_stream)
+    record: keep the incremental export as pending until its apply is acked (only for the apply itself)
+    '''
     host_child_ids = [c.id for c in Child.query.filter(Child.mode == ChildMode.virtual).all()]
-    configs = {
-        "users": valid_users,
+    configs = export_users(incremental, record=record and incremental)
+    if not stream:
+        configs['users'] = list(configs['users'])
+        configs['removed_users'] = list(configs['removed_users'])
+    configs.update({
         "domains": [u.to_dict(dump_ports=True, dump_child_id=True) for u in Domain.query.filter(Domain.child_id.in_(host_child_ids)).all() if "*" not in u.domain],
         # "hconfigs": get_hconfigs(json=True),
         "chconfigs": get_hconfigs_childs(host_child_ids, json=True)
-    }
+    })
 
-    def_user = None if len(User.query.all()) > 1 else User.query.filter(User.name == 'default').first()
+    def_user = None if User.query.count() > 1 else User.query.filter(User.name == 'default').first()
     domains = Domain.query.all()
     sslip_domains = [d.domain for d in domains if "sslip.io" in d.domain]
 
@@ -370,3 +568,20 @@ def all_configs_for_cli():
         configs['panel_links'].append(get_account_panel_link(owner, d.domain))
 
     return configs
+
+
+def write_json_stream(data: dict, out):
+    '''
+    Writes data as compact json, the generator values are written item by item as lists
+    '''
+    out.write('{')
+    for i, (key, value) in enumerate(data.items()):
+        out.write(f'{"," if i else ""}{json.dumps(key)}:')
+        if isinstance(value, types.GeneratorType):
+            out.write('[')
+            for j, item in enumerate(value):
+                out.write(f'{"," if j else ""}{json.dumps(item, separators=(",", ":"))}')
+            out.write(']')
+        else:
+            out.write(json.dumps(value, separators=(",", ":")))
+    out.write('}\n')
@@ -14,7 +14,27 @@ from hiddifypanel.database import db, db_execute
 from flask import g
 from sqlalchemy import func, text
 from loguru import logger
-MAX_DB_VERSION = 100
+MAX_DB_VERSION = 101  # exclusive, the last migration is _v100
+
+
+def _v100(child_id):
+    if child_id != 0:
+        return
+    execute('CREATE INDEX ix_user_expires_on ON user (expires_on);')
+    for user in User.query.filter(User.start_date.isnot(None)):
+        user.expires_on = user.calc_expires_on()
+
+
+def _v99(child_id):
+    if child_id != 0:
+        return
+    execute('CREATE INDEX ix_user_next_reset_date ON user (next_reset_date);')
+    for user in User.query.filter(User.mode != UserMode.no_reset):
+        user.next_reset_date = user.calc_next_reset_date()
+
+
+def _v98(child_id):
+    execute('CREATE INDEX ix_user_last_online ON user (last_online);')
 
 
 def _v97(child_id):
@@ -852,6 +872,8 @@ def init_db():
                         child_id=child.id, commit=False)
 
         db.session.commit()
+    # the migrations use bulk_save_objects and raw sql, which skip the orm hooks that bump it
+    bump_config_revision()
     g.child = Child.by_id(0)
     return BoolConfig.query.all()
 
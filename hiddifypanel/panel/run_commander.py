@@ -1,9 +1,29 @@
 from typing import List
 from strenum import StrEnum
 from flask import current_app
+from loguru import logger
 import subprocess
+import threading
+import hashlib
+import uuid
+import time
 import os
 
+from hiddifypanel.cache import redis_client
+
+JOB_KEY = "commander:job:"  # + job id, a hash of the job state
+JOB_INFLIGHT_KEY = "commander:inflight:"  # + hash of the command line, the id of its queued or running job
+JOB_TTL = 24 * 3600  # seconds that a job is kept after it is finished, its output file is deleted after that
+JOBS_DIR = 'log/system/commander'  # in HIDDIFY_CONFIG_PATH, only readable by the panel user
+
+
+class JobStatus(StrEnum):
+    queued = 'queued'
+    running = 'running'
+    finished = 'finished'
+    failed = 'failed'
+    unknown = 'unknown'  # its process is gone while the panel was not waiting for it, so its returncode is not known
+
 
 class Command(StrEnum):
     apply = 'apply'
@@ -25,7 +45,8 @@ def commander(command: Command, run_in_background=True, **kwargs: str | int) ->
     Run the commander based on the given command type.
     Args:
         command: The type of command to run.
-        run_in_background: Whether to run the command in the background.
+        run_in_background: Whether to run the command in the background. If so, it is run as a job
+                           and the job id is returned (see get_job), otherwise its output is returned.
         **kwargs: Additional arguments to pass to the commander. Accepts the following:
                   url, slug, period for the temporary-short-link command.
                   port for the temporary-access command.
@@ -80,6 +101,115 @@ def commander(command: Command, run_in_background=True, **kwargs: str | int) ->
     else:
         raise Exception('WTF is happening!')
     if run_in_background:
-        subprocess.Popen(base_cmd, cwd=str(current_app.config['HIDDIFY_CONFIG_PATH']), start_new_session=True)
+        return submit_job(base_cmd, cwd=str(current_app.config['HIDDIFY_CONFIG_PATH']))
     else:
         return subprocess.check_output(base_cmd, cwd=str(current_app.config['HIDDIFY_CONFIG_PATH'])).decode()
+
+
+def submit_job(cmd: List[str], cwd: str) -> str:
+    """
+    Runs the command in its own session, so it outlives the panel (e.g. on update), and tracks it in redis.
+    An identical command that is still queued or running is not started again, its job id is returned instead.
+    """
+    job_id = str(uuid.uuid4())
+    inflight_key = JOB_INFLIGHT_KEY + hashlib.sha256('\0'.join(cmd).encode()).hexdigest()
+    if not redis_client.set(inflight_key, job_id, nx=True, ex=JOB_TTL):
+        existing = redis_client.get(inflight_key)
+        if existing and (job := get_job(existing.decode())) and job['status'] in (JobStatus.queued, JobStatus.running):
+            return existing.decode()
+        redis_client.set(inflight_key, job_id, ex=JOB_TTL)
+
+    jobs_dir = os.path.join(current_app.config['HIDDIFY_CONFIG_PATH'], JOBS_DIR)
+    os.makedirs(jobs_dir, mode=0o700, exist_ok=True)
+    os.chmod(jobs_dir, 0o700)
+    _delete_expired_outputs(jobs_dir)
+    output_path = os.path.join(jobs_dir, f'{job_id}.log')
+    redis_client.hset(JOB_KEY + job_id, mapping={
+        'id': job_id,
+        'command': ' '.join(cmd[2:]),
+        'status': JobStatus.queued,
+        'output_path': output_path,
+        'created': time.time(),
+    })
+    redis_client.expire(JOB_KEY + job_id, JOB_TTL)
+    with open(os.open(output_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'wb') as output:
+        proc = subprocess.Popen(cmd, cwd=cwd, stdout=output, stderr=subprocess.STDOUT, start_new_session=True)
+    redis_client.hset(JOB_KEY + job_id, mapping={'status': JobStatus.running, 'pid': proc.pid, 'started': time.time()})
+    threading.Thread(target=_wait_job, args=(job_id, proc, inflight_key), daemon=True).start()
+    return job_id
+
+
+def _delete_expired_outputs(jobs_dir: str):
+    '''Deletes the output files of the jobs whose state is expired from redis'''
+    job_ids = [name[:-len('.log')] for name in os.listdir(jobs_dir) if name.endswith('.log')]
+    if not job_ids:
+        return
+    with redis_client.pipeline() as pipe:
+        for job_id in job_ids:
+            pipe.exists(JOB_KEY + job_id)
+        exists = pipe.execute()
+    for job_id, exist in zip(job_ids, exists):
+        if not exist:
+            try:
+                os.remove(os.path.join(jobs_dir, f'{job_id}.log'))
+            except OSError:
+                pass
+
+
+def _wait_job(job_id: str, proc: subprocess.Popen, inflight_key: str):
+    returncode = proc.wait()
+    status = JobStatus.finished if returncode == 0 else JobStatus.failed
+    with redis_client.pipeline() as pipe:
+        pipe.hset(JOB_KEY + job_id, mapping={'status': status, 'returncode': returncode, 'finished': time.time()})
+        pipe.expire(JOB_KEY + job_id, JOB_TTL)
+        pipe.delete(inflight_key)
+        pipe.execute()
+    logger.info(f'commander job {job_id} {status} with returncode={returncode}')
+
+
+def get_job(job_id: str, offset: int = 0) -> dict | None:
+    """
+    Returns the state of the job and its output from the given byte offset, or None if it is unknown or expired.
+    """
+    job = {k.decode(): v.decode() for k, v in redis_client.hgetall(JOB_KEY + job_id).items()}
+    if not job:
+        return None
+    if job['status'] == JobStatus.running and not _is_alive(int(job['pid'])):
+        # the panel is restarted while the job was running, so its waiter is gone
+        job['status'] = JobStatus.unknown
+        job['returncode'] = None
+    output = b''
+    try:
+        if offset < 0:
+            raise FileNotFoundError()
+        with open(job.pop('output_path'), 'rb') as f:
+            f.seek(offset)
+            output = f.read()
+    except OSError:
+        pass
+    job['output'] = output.decode(errors='replace')
+    job['offset'] = max(0, offset) + len(output)
+    return job
+
+
+def wait_job(job_id: str, timeout: float, interval: float = 1) -> dict | None:
+    """
+    Waits until the job is finished or the timeout is reached, and returns its state without the output.
+    """
+    deadline = time.monotonic() + timeout
+    while (job := get_job(job_id, offset=-1)) and job['status'] in (JobStatus.queued, JobStatus.running):
+        if time.monotonic() >= deadline:
+            break
+        time.sleep(interval)
+    return job
+
+
+def _is_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # it is run by sudo as root
+        return True
+    return True
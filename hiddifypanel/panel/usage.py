@@ -1,7 +1,12 @@
 from flask_babel import lazy_gettext as _
-from sqlalchemy import func
+from sqlalchemy import func, update, case, bindparam
+from sqlalchemy.orm import load_only
+from sqlalchemy.orm.attributes import set_committed_value
 from typing import Dict
+from collections import defaultdict
 import datetime
+import json
+import redis
 
 from hiddifypanel.drivers import user_driver
 from hiddifypanel.models import *
@@ -10,6 +15,13 @@ from hiddifypanel.database import db
 from hiddifypanel import cache, hutils
 from loguru import logger
 to_gig_d = 1024**3
+USAGE_BULK_CHUNK_SIZE = 1000
+USAGE_STREAM = "usage:stream"
+USAGE_STREAM_GROUP = "usage-accounting"
+USAGE_STREAM_CONSUMER = "panel"
+# the columns that the accounting reads, the others are not loaded
+USAGE_USER_COLUMNS = (User.id, User.uuid, User.added_by, User.current_usage, User.start_date,
+                      User.last_reset_time, User.mode, User.package_days)
 
 
 def update_local_usage():
@@ -17,139 +29,231 @@ def update_local_usage():
     if not cache.redis_client.set(lock_key, "locked", nx=True, ex=600):
         return {"msg": "last update task is not finished yet."}
     try:
-        res = user_driver.get_users_usage(reset=True)
+        push_users_usage(user_driver.get_users_usage(reset=True), child_id=0)
+        res = drain_users_usage()
         # cache.redis_client.delete(lock_key)
         cache.redis_client.set(lock_key, "locked", nx=False, ex=60)
-        return _add_users_usage(res, child_id=0)
     except Exception as e:
         cache.redis_client.set(lock_key, "locked", nx=False, ex=60)
         logger.exception("Exception in update usage")
         raise
         return {"msg": f"Exception in update usage: {e}"}
 
-    # return {"status": 'success', "comments":res}
+    # the slow steps (drivers, telegram, parent) have their own lock so they never delay the accounting
+    downstream_lock_key = "lock-update-local-usage-downstream"
+    if not cache.redis_client.set(downstream_lock_key, "locked", nx=True, ex=600):
+        return {"status": 'success', "comments": res, "msg": "last reconcile task is not finished yet.", "date": hutils.convert.time_to_json(datetime.datetime.now())}
+    try:
+        return _after_users_usage(res, sync=False)
+    finally:
+        cache.redis_client.delete(downstream_lock_key)
 
 
 def add_users_usage_uuid(uuids_bytes: Dict[str, Dict], child_id, sync=False):
-    uuids_bytes = {u: v for u, v in uuids_bytes.items() if v}
-    uuids = uuids_bytes.keys()
-    users = User.query.filter(User.uuid.in_(uuids))
-    dbusers_bytes = {u: uuids_bytes.get(u.uuid, 0) for u in users}
-    _add_users_usage(dbusers_bytes, child_id, sync)  # type: ignore
+    return _add_users_usage(uuids_bytes, child_id, sync)
 
 
-def _reset_priodic_usage():
-    last_usage_check: int = hconfig(ConfigEnum.last_priodic_usage_check) or 0
-    import time
-    current_time = int(time.time())
-    if current_time - last_usage_check < 60 * 60 * 6:
+def push_users_usage(uuids_usage: Dict[str, Dict], child_id):
+    '''
+    Appends the non-zero {uuid: {'usage': bytes}} deltas to the usage stream, it does not touch the database
+    '''
+    deltas = [(uuid, v['usage']) for uuid, v in uuids_usage.items() if v and v.get('usage')]
+    if not deltas:
         return
-    # reset as soon as possible in the day
-    if datetime.datetime.now().hour > 5 and current_time - last_usage_check < 60 * 60 * 24:
+    pipe = cache.redis_client.pipeline()
+    for i in range(0, len(deltas), USAGE_BULK_CHUNK_SIZE):
+        pipe.xadd(USAGE_STREAM, {'child_id': child_id, 'usage': json.dumps(dict(deltas[i:i + USAGE_BULK_CHUNK_SIZE]))})
+    pipe.execute()
+
+
+def drain_users_usage(batch_size: int = 100) -> dict:
+    '''
+    Accounts the usage stream into the database in batches of stream entries.
+    It is at-least-once: entries are acked after the commit, and the last accounted stream id
+    is committed with the usages so a redelivered entry is skipped instead of being counted twice.
+    '''
+    redis_client = cache.redis_client
+    try:
+        redis_client.xgroup_create(USAGE_STREAM, USAGE_STREAM_GROUP, id='0', mkstream=True)
+    except redis.ResponseError:
+        pass  # the group already exists
+
+    # they do not depend on the traffic, so they run on every tick even if the stream is empty
+    _reset_priodic_usage()
+    _get_daily_usages(datetime.date.today(), 0)
+    db.session.commit()
+
+    res = {}
+    while entries := _read_usage_stream(batch_size):
+        cursor = UsageStreamCursor.for_update()
+        last_id = _stream_id(cursor.last_id)
+        children_usage = defaultdict(lambda: defaultdict(lambda: {'usage': 0, 'devices': ''}))
+        for entry_id, fields in entries:
+            if not fields or _stream_id(entry_id) <= last_id:
+                continue
+            fields = {_decode(k): _decode(v) for k, v in fields.items()}
+            for uuid, usage in json.loads(fields['usage']).items():
+                children_usage[int(fields['child_id'])][uuid]['usage'] += usage
+
+        for child_id, uuids_usage in children_usage.items():
+            res.update(_account_users_usage(uuids_usage, child_id, commit=False, reset=False))
+        last_id = max(last_id, *(_stream_id(entry_id) for entry_id, _ in entries))
+        cursor.last_id = '-'.join(map(str, last_id))
+        db.session.commit()
+
+        entry_ids = [entry_id for entry_id, _ in entries]
+        redis_client.xack(USAGE_STREAM, USAGE_STREAM_GROUP, *entry_ids)
+        redis_client.xdel(USAGE_STREAM, *entry_ids)
+    return res
+
+
+def _read_usage_stream(count: int) -> list:
+    # the pending entries (delivered but not acked because of a crash) come first
+    for start_id in ('0', '>'):
+        streams = cache.redis_client.xreadgroup(USAGE_STREAM_GROUP, USAGE_STREAM_CONSUMER, {USAGE_STREAM: start_id}, count=count)
+        if streams and streams[0][1]:
+            return streams[0][1]
+    return []
+
+
+def _stream_id(entry_id) -> tuple:
+    ms, seq = _decode(entry_id).split('-')
+    return int(ms), int(seq)
+
+
+def _decode(value) -> str:
+    return value.decode() if isinstance(value, bytes) else str(value)
+
+
+def _get_users_by_uuids(uuids, columns=None) -> Dict[str, User]:
+    '''columns: the only ones to load, the whole users are loaded if it is not given'''
+    uuids = list(uuids)
+    users = {}
+    query = User.query.options(load_only(*columns)) if columns else User.query
+    for i in range(0, len(uuids), USAGE_BULK_CHUNK_SIZE):
+        for user in query.filter(User.uuid.in_(uuids[i:i + USAGE_BULK_CHUNK_SIZE])):
+            users[user.uuid] = user
+    return users
+
+
+def _get_users_to_reconcile(enabled_users: Dict[str, bool]) -> tuple[list[User], list[User]]:
+    '''
+    Returns (to_add, to_remove) by comparing the active uuids with the enabled ones of the drivers,
+    only the users to add are loaded as whole objects. The removed ones that are not in the database
+    (invalid users) have no id.
+    '''
+    enabled = {u for u, v in enabled_users.items() if v}
+    active = {u for u, in db.session.query(User.uuid).filter(User.is_active)}
+    to_add = list(_get_users_by_uuids(active - enabled).values())
+
+    removed = list(enabled - active)
+    existing = {}
+    for i in range(0, len(removed), USAGE_BULK_CHUNK_SIZE):
+        existing.update({u: uid for uid, u in db.session.query(User.id, User.uuid).filter(User.uuid.in_(removed[i:i + USAGE_BULK_CHUNK_SIZE]))})
+    to_remove = [User(id=existing.get(uuid), uuid=uuid) for uuid in removed]
+    return to_add, to_remove
+
+
+def _get_daily_usages(today: datetime.date, child_id) -> Dict[int, DailyUsage]:
+    '''
+    Returns today's DailyUsage of every admin with the online count refreshed,
+    missing rows are created in one insert and the counts come from one grouped query.
+    '''
+    daily_usage = {d.admin_id: d for d in DailyUsage.query.filter(DailyUsage.date == today, DailyUsage.child_id == child_id)}
+    missing = [admin_id for admin_id, in db.session.query(AdminUser.id) if admin_id not in daily_usage]
+    if missing:
+        logger.info(f"creating new daily usages {today} admins={missing} child={child_id}")
+        new_usages = [DailyUsage(date=today, admin_id=admin_id, child_id=child_id) for admin_id in missing]
+        db.session.add_all(new_usages)
+        db.session.flush()
+        daily_usage.update({d.admin_id: d for d in new_usages})
+
+    today_start = datetime.datetime.combine(today, datetime.time.min)
+    online = dict(db.session.query(User.added_by, func.count(User.id)).filter(User.last_online >= today_start).group_by(User.added_by))
+    for admin_id, d in daily_usage.items():
+        d.online = online.get(admin_id, 0)
+    return daily_usage
+
+
+def _reset_priodic_usage():
+    '''
+    Resets the users whose next_reset_date has come, it is an indexed range query so it runs on every tick
+    '''
+    today = datetime.date.today()
+    users = User.query.filter(User.next_reset_date <= today).options(load_only(User.id, User.uuid, User.mode, User.start_date, User.last_reset_time))
+    rows = []
+    for user in users:
+        logger.info(f"reseting user usage for {user.uuid}")
+        set_committed_value(user, 'last_reset_time', today)
+        rows.append({'b_id': user.id, 'b_next': user.calc_next_reset_date()})
+    if not rows:
         return
-    logger.debug("reseting user usage if needed")
-    for user in User.query.filter(User.mode != UserMode.no_reset).all():
-        if user.user_should_reset():
-            logger.info(f"reseting user usage for {user.uuid}")
-            user.reset_usage(commit=False)
-    set_hconfig(ConfigEnum.last_priodic_usage_check, current_time)
+    table = User.__table__
+    stmt = update(table).where(table.c.id == bindparam('b_id')).values(
+        current_usage=0,
+        last_reset_time=today,
+        next_reset_date=bindparam('b_next'),
+    )
+    conn = db.session.connection()
+    for i in range(0, len(rows), USAGE_BULK_CHUNK_SIZE):
+        conn.execute(stmt, rows[i:i + USAGE_BULK_CHUNK_SIZE])
 
 
-def _add_users_usage(users_usage_data: Dict[User, Dict], child_id, sync=False):
+def _add_users_usage(uuids_usage: Dict[str, Dict], child_id, sync=False):
     '''
+    uuids_usage: {uuid: {'usage': bytes, 'devices': ''}} as returned by user_driver.get_users_usage
     sync: when enabled, it means we have received usages from the parent panel
     '''
-    res = {}
-    have_change = False
-    before_enabled_users = user_driver.get_enabled_users()
+    res = _account_users_usage(uuids_usage, child_id, sync)
+    return _after_users_usage(res, sync)
+
 
-    daily_usage = {}
+def _account_users_usage(uuids_usage: Dict[str, Dict], child_id, sync=False, commit=True, reset=True) -> dict:
+    '''
+    Writes the usages, the daily usages and the periodic resets (unless reset is False) to the database without calling any driver.
+    '''
+    res = {}
     today = datetime.date.today()
-    changes = False
-    for adm in AdminUser.query.all():
-        daily_usage[adm.id] = DailyUsage.query.filter(DailyUsage.date == today, DailyUsage.admin_id == adm.id, DailyUsage.child_id == child_id).first()
-        if daily_usage[adm.id] is None:
-            logger.info(f"creating a new daily usage {today} admin={adm.id} child={child_id}")
-            daily_usage[adm.id] = DailyUsage(date=today, admin_id=adm.id, child_id=child_id)
-            db.session.add(daily_usage[adm.id])
-            changes = True
-        daily_usage[adm.id].online = User.query.filter(User.added_by == adm.id).filter(func.DATE(User.last_online) == today).count()
-    if changes:
-        db.session.commit()
-    _reset_priodic_usage()
+    daily_usage = _get_daily_usages(today, child_id)
+    if reset:
+        _reset_priodic_usage()
 
     # userDetails = {p.user_id: p for p in UserDetail.query.filter(UserDetail.child_id == child_id).all()}
-    for user, uinfo in users_usage_data.items():
-        usage_bytes = uinfo['usage']
-
-        # UserDetails things
-        # detail = UserDetail(user_id=user.id, child_id=child_id)
-        # detail = userDetails.get(user.id)
-        # if not detail:
-        #     detail = UserDetail(user_id=user.id, child_id=child_id)
-        #     db.session.add(detail)
-        # if uinfo['devices'] != detail.connected_devices:
-        #     detail.connected_devices = uinfo['devices']
-
-        # Enable the user if isn't already
-        if not before_enabled_users[user.uuid] and user.is_active:
-            logger.info(f"Enabling disabled client {user.uuid} ")
-            user_driver.add_client(user)
-            send_bot_message(user)
-            have_change = True
-
-        # Check if there's new usage value
-        if not isinstance(usage_bytes, int) or usage_bytes == 0:
-            res[user.uuid] = "No usage"
+    now = datetime.datetime.now()
+    users_usage = {}
+    started = {}
+    # only the ones with a new usage value
+    uuids = (u for u, v in uuids_usage.items() if v and isinstance(v.get('usage'), int) and v['usage'])
+    users = _get_users_by_uuids(uuids, USAGE_USER_COLUMNS)
+    for user in users.values():
+        usage_bytes = uuids_usage[user.uuid]['usage']
+        # Set new daily usage of the user
+        if sync and daily_usage.get(user.added_by, daily_usage[1]).usage != usage_bytes:
+            daily_usage.get(user.added_by, daily_usage[1]).usage = usage_bytes
         else:
-            # Set new daily usage of the user
-            if sync and daily_usage.get(user.added_by, daily_usage[1]).usage != usage_bytes:
-                daily_usage.get(user.added_by, daily_usage[1]).usage = usage_bytes
-            else:
-                daily_usage.get(user.added_by, daily_usage[1]).usage += usage_bytes
-
-            in_bytes = usage_bytes
-
-            # Set new current usage of the user
-            if sync and user.current_usage != in_bytes:
-                user.current_usage = in_bytes
-                # detail.current_usage_GB = in_gig
-            else:
-                user.current_usage += in_bytes
-                # detail.current_usage = detail.current_usage or 0
-                # detail.current_usage += in_bytes
-
-            # Change last online time of the user
-            user.last_online = datetime.datetime.now()
-            # detail.last_online = datetime.datetime.now()
-
-            # Set start date of user to the current datetime if it hasn't been set already
-            if user.start_date is None:
-                user.start_date = datetime.date.today()
-
-            res[user.uuid] = f'{in_bytes/1000000:0.3f}MB'
-
-        # Remove user from drivers(singbox, xray, wireguard etc.) if they're inactive
-        # print(before_enabled_users[user.uuid], user.is_active)
-        if before_enabled_users[user.uuid] and not user.is_active:
-            logger.info(f"Removing enabled client {user.uuid} ")
+            daily_usage.get(user.added_by, daily_usage[1]).usage += usage_bytes
 
-            user_driver.remove_client(user)
-            have_change = True
-            res[user.uuid] = f"{res[user.uuid]} !OUT of USAGE! Client Removed"
+        users_usage[user.id] = usage_bytes
+        if user.start_date is None:
+            # the usage starts the package, so the reset schedule and the expiry start too
+            started[user.id] = {'b_next': user.calc_next_reset_date(start_date=now.date()),
+                                'b_expires': user.calc_expires_on(start_date=now.date())}
+        # Keep the loaded object in line with the bulk update without marking it dirty
+        _set_committed_usage(user, usage_bytes, now, sync)
 
-    db.session.commit()  # type: ignore
+        res[user.uuid] = f'{usage_bytes/1000000:0.3f}MB'
 
-    # Remove invalid users
-    for uuid in before_enabled_users:
-        if uuid in res:
-            continue
+    _bulk_update_users_usage(users_usage, started, now, sync)
+    if commit:
+        db.session.commit()  # type: ignore
+    return res
 
-        user = User.query.filter(User.uuid == uuid).first()
-        if not user:
-            user_driver.remove_client(User(uuid=uuid))
-        elif not user.is_active:
-            user_driver.remove_client(user)
+
+def _after_users_usage(res: dict, sync=False) -> dict:
+    '''
+    The steps after the accounting: driver reconciliation, telegram messages and the parent sync.
+    '''
+    have_change = _reconcile_drivers(res)
 
     # print("------------------", res)
     # Apply the changes to the drivers
@@ -163,6 +267,70 @@ def _add_users_usage(users_usage_data: Dict[User, Dict], child_id, sync=False):
     return {"status": 'success', "comments": res, "date": hutils.convert.time_to_json(datetime.datetime.now())}
 
 
+def _reconcile_drivers(res: dict) -> bool:
+    before_enabled_users = user_driver.get_enabled_users()
+    to_add, to_remove = _get_users_to_reconcile(before_enabled_users)
+    # Enable the users if they aren't already
+    for user in to_add:
+        logger.info(f"Enabling disabled client {user.uuid} ")
+
+    # Remove users from drivers(singbox, xray, wireguard etc.) if they're inactive, or invalid
+    for user in to_remove:
+        if user.id:
+            logger.info(f"Removing enabled client {user.uuid} ")
+            res[user.uuid] = f"{res.get(user.uuid, 'No usage')} !OUT of USAGE! Client Removed"
+
+    if to_add or to_remove:
+        # the activity is changed by sql updates, so the orm hooks have not seen it
+        bump_users_revision()
+    user_driver.add_clients(to_add)
+    user_driver.remove_clients(to_remove)
+    for user in to_add:
+        send_bot_message(user)
+    return bool(to_add) or any(u.id for u in to_remove)
+
+
+def _bulk_update_users_usage(users_usage: Dict[int, int], started: Dict[int, Dict], now: datetime.datetime, sync=False):
+    '''
+    Applies {user_id: usage_bytes} with batched executemany UPDATEs instead of flushing each ORM object.
+    started: {user_id: {'b_next': next_reset_date, 'b_expires': expires_on}} for the users whose start_date is being set by this usage
+    sync: set current_usage to the received value (as the parent panel sends totals) unless it is already equal
+    '''
+    if not users_usage:
+        return
+    table = User.__table__
+    if sync:
+        current_usage = case((table.c.current_usage != bindparam('b_usage'), bindparam('b_usage')),
+                             else_=table.c.current_usage + bindparam('b_usage'))
+    else:
+        current_usage = table.c.current_usage + bindparam('b_usage')
+    stmt = update(table).where(table.c.id == bindparam('b_id')).values(
+        current_usage=current_usage,
+        last_online=now,
+        start_date=func.coalesce(table.c.start_date, now.date()),
+        next_reset_date=func.coalesce(bindparam('b_next', type_=table.c.next_reset_date.type), table.c.next_reset_date),
+        expires_on=func.coalesce(bindparam('b_expires', type_=table.c.expires_on.type), table.c.expires_on),
+    )
+    not_started = {'b_next': None, 'b_expires': None}
+    rows = [{'b_id': uid, 'b_usage': usage, **started.get(uid, not_started)} for uid, usage in users_usage.items()]
+    conn = db.session.connection()
+    for i in range(0, len(rows), USAGE_BULK_CHUNK_SIZE):
+        conn.execute(stmt, rows[i:i + USAGE_BULK_CHUNK_SIZE])
+
+
+def _set_committed_usage(user: User, usage_bytes: int, now: datetime.datetime, sync=False):
+    if sync and user.current_usage != usage_bytes:
+        current_usage = usage_bytes
+    else:
+        current_usage = (user.current_usage or 0) + usage_bytes
+    set_committed_value(user, 'current_usage', current_usage)
+    set_committed_value(user, 'last_online', now)
+    if user.start_date is None:
+        set_committed_value(user, 'start_date', now.date())
+        set_committed_value(user, 'next_reset_date', user.calc_next_reset_date())
+        set_committed_value(user, 'expires_on', user.calc_expires_on())
+
+
 def send_bot_message(user):
     if not (hconfig(ConfigEnum.telegram_bot_token) or hutils.node.is_child()):
         return
@@ -1,6 +1,8 @@
 import user_agents
 import datetime
+import hashlib
 import random
+import json
 import re
 
 from flask import render_template, request, Response, g
@@ -10,12 +12,20 @@ from flask_babel import gettext as _
 
 
 from hiddifypanel.auth import login_required
+from hiddifypanel.cache import redis_client
 from hiddifypanel.database import db
 from hiddifypanel.panel import hiddify
 from hiddifypanel.models import *
 from hiddifypanel import hutils
 
 
+SUB_CACHE_KEY = "sub:"  # + digest of the parts the output depends on, see cached_sub
+SUB_CACHE_TTL = 10 * 60  # the entries are not invalidated but keyed on the revisions, this only bounds the memory
+# the user fields that the subscriptions are made of, the dates are in the key as expire_days and reset_day
+SUB_USER_FIELDS = ('uuid', 'name', 'lang', 'enable', 'is_active', 'mode', 'package_days', 'usage_limit_GB',
+                   'wg_pk', 'wg_pub', 'wg_psk', 'ed25519_private_key', 'ed25519_public_key')
+
+
 class UserView(FlaskView):
 
     def index(self):
@@ -56,7 +66,8 @@ class UserView(FlaskView):
         # if not hconfig(ConfigEnum.sub_full_xray_json_enable):
         #     return 'The Full Xray subscription is disabled'
         c = get_common_data(g.account.uuid, mode="new")
-        configs = hutils.proxy.xrayjson.configs_as_json(c['domains'], c['user'], c['expire_days'], c['profile_title'])
+        compact = request.args.get("compact", "").lower() == "true"
+        configs = cached_sub(c, lambda: hutils.proxy.xrayjson.configs_as_json(c['domains'], c['user'], c['expire_days'], c['profile_title'], compact=compact))
         return add_headers(configs, c, 'application/json')
 
     @route("/singbox/")
@@ -171,8 +182,7 @@ Endpoint = {next(iter(servers))}:61339 #{servers}
         domain = request.args.get("domain", None)
 
         c = get_common_data(g.account.uuid, mode, filter_domain=domain)
-        resp = Response(render_template('clash_proxies.yml',
-                        meta_or_normal=meta_or_normal, **c))
+        resp = Response(cached_sub(c, lambda: render_template('clash_proxies.yml', meta_or_normal=meta_or_normal, **c)))
         resp.mimetype = "text/plain"
 
         return resp
@@ -231,8 +241,7 @@ Endpoint = {next(iter(servers))}:61339 #{servers}
         if request.method == 'HEAD':
             resp = ""
         else:
-            resp = render_template(
-                'clash_config.yml', typ=typ, meta_or_normal=meta_or_normal, **c, hash=hash_rnd)
+            resp = cached_sub(c, lambda: render_template('clash_config.yml', typ=typ, meta_or_normal=meta_or_normal, **c, hash=hash_rnd))
 
         return add_headers(resp, c)
 
@@ -248,7 +257,7 @@ Endpoint = {next(iter(servers))}:61339 #{servers}
         if request.method == 'HEAD':
             resp = ""
         else:
-            resp = hutils.proxy.singbox.configs_as_json(**c)
+            resp = cached_sub(c, lambda: hutils.proxy.singbox.configs_as_json(**c))
 
         return add_headers(resp, c, 'application/json')
 
@@ -266,8 +275,8 @@ Endpoint = {next(iter(servers))}:61339 #{servers}
         if request.method == 'HEAD':
             resp = ""
         else:
-            resp = render_template('singbox_config.json', **c, host_keys=hutils.proxy.get_ssh_hostkeys(get_hconfigs(),True),
-                                   ssh_client_version=hiddify.get_ssh_client_version(user), ssh_ip=hutils.network.get_direct_host_or_ip(4), base64=False)
+            resp = cached_sub(c, lambda: render_template('singbox_config.json', **c, host_keys=hutils.proxy.get_ssh_hostkeys(get_hconfigs(), True),
+                                                         ssh_client_version=hiddify.get_ssh_client_version(user), ssh_ip=hutils.network.get_direct_host_or_ip(4), base64=False))
 
         return add_headers(resp, c)
 
@@ -288,7 +297,9 @@ Endpoint = {next(iter(servers))}:61339 #{servers}
             resp = ""
         else:
             # render_template('all_configs.txt', **c, base64=hutils.encode.do_base_64)
-            resp = hutils.proxy.xray.make_v2ray_configs(c['domains'], c['user'], c['expire_days'], c['ip_debug'])
+            # the usage line of the links has the time in it
+            minute = c['fake_ip_for_sub_link'] if hconfig(ConfigEnum.show_usage_in_sublink) else None
+            resp = cached_sub(c, lambda: hutils.proxy.xray.make_v2ray_configs(c['domains'], c['user'], c['expire_days'], c['ip_debug']), minute)
 
         if base64:
             resp = hutils.encode.do_base_64(resp)
@@ -420,6 +431,31 @@ def get_common_data(user_uuid, mode, no_domain=False, filter_domain=None):
     }
 
 
+def cached_sub(c, render, *extra_key):
+    '''
+    Returns the rendered subscription from the cache or renders and caches it.
+    The key has everything the output depends on: the user, the endpoint and its args, the client features, the host,
+    the asn choice, the language and the config revision (bumped on config, domain, proxy and child changes).
+    '''
+    if g.user_agent.get('is_browser'):
+        # the browsers get the debug info of their ip
+        return render()
+    user = c['user']
+    user_state = {k: getattr(user, k) for k in SUB_USER_FIELDS}
+    if hconfig(ConfigEnum.show_usage_in_sublink):
+        # only then the usage is shown, otherwise it would change the key on every usage update
+        user_state['current_usage_GB'] = round(user.current_usage_GB, 3)
+    key_parts = [user_state, c['expire_days'], c['reset_day'], request.path, sorted(request.args.items(multi=True)),
+                 g.user_agent, request.host, c['asn'] if c['has_auto_cdn'] else None, g.get('locale'), get_config_revision(), extra_key]
+    key = SUB_CACHE_KEY + hashlib.sha256(json.dumps(key_parts, sort_keys=True, default=str).encode()).hexdigest()
+    if (cached := redis_client.get(key)) is not None:
+        return cached.decode()
+    res = render()
+    if not g.pop('sub_uncacheable', False):
+        redis_client.set(key, res, ex=SUB_CACHE_TTL)
+    return res
+
+
 def add_headers(res, c, mimetype="text/plain"):
     resp = Response(res)
     resp.mimetype = mimetype
@@ -0,0 +1,131 @@
+"""
+A stand-in for the xray (127.0.0.1:10085) and singbox (127.0.0.1:10086) api of the cores, for load testing
+the usage pipeline without them. It implements the subset used by XrayApi and SingboxApi:
+QueryStats (with reset) and GetSysStats of the StatsService and AlterInbound (add/remove user) of the HandlerService.
+
+Every user of the inbounds gets random traffic on each QueryStats, and each call waits --latency ms.
+
+    python fake_core_server.py --users 10000 --inbounds vless,trojan,vmess --latency 5
+"""
+import random
+import threading
+import time
+import uuid
+from collections import Counter, defaultdict
+from concurrent import futures
+
+import click
+import grpc
+from xtlsapi.xray_api.app.proxyman.command import command_pb2 as handler_pb2
+from xtlsapi.xray_api.app.stats.command import command_pb2 as stats_pb2
+
+# singbox serves the v2ray compatible api, its messages are the same on the wire as the xray ones
+STATS_SERVICES = ["xray.app.stats.command.StatsService", "v2ray.core.app.stats.command.StatsService"]
+HANDLER_SERVICE = "xray.app.proxyman.command.HandlerService"
+
+
+class FakeCore:
+    def __init__(self, uuids, inbounds, latency_ms=0, max_traffic=10 * 1024**2):
+        self.inbounds = {tag: {f'{u}@hiddify.com' for u in uuids} for tag in inbounds}
+        self.latency = latency_ms / 1000
+        self.max_traffic = max_traffic
+        self.started = time.time()
+        self.calls = Counter()  # method -> number of calls
+        self.lock = threading.Lock()
+        self.traffic = defaultdict(int)  # stat name -> value since the last reset
+
+    def _call(self, method):
+        self.calls[method] += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def _generate_traffic(self):
+        for tag, emails in self.inbounds.items():
+            for email in emails:
+                up, down = random.randint(0, self.max_traffic), random.randint(0, self.max_traffic)
+                self.traffic[f'user>>>{email}>>>traffic>>>uplink'] += up
+                self.traffic[f'user>>>{email}>>>traffic>>>downlink'] += down
+                self.traffic[f'inbound>>>{tag}>>>traffic>>>uplink'] += up
+                self.traffic[f'inbound>>>{tag}>>>traffic>>>downlink'] += down
+
+    def query_stats(self, request, context):
+        self._call('QueryStats')
+        with self.lock:
+            if request.pattern in ('', 'user'):
+                self._generate_traffic()
+            if request.pattern == 'inbound':
+                # the inbounds are listed even before they have traffic
+                for tag in self.inbounds:
+                    self.traffic.setdefault(f'inbound>>>{tag}>>>traffic>>>uplink', 0)
+            stats = [stats_pb2.Stat(name=name, value=value) for name, value in self.traffic.items() if request.pattern in name]
+            if request.reset:
+                for stat in stats:
+                    self.traffic[stat.name] = 0
+        return stats_pb2.QueryStatsResponse(stat=stats)
+
+    def get_sys_stats(self, request, context):
+        self._call('GetSysStats')
+        return stats_pb2.SysStatsResponse(Uptime=int(time.time() - self.started))
+
+    def alter_inbound(self, request, context):
+        self._call('AlterInbound')
+        emails = self.inbounds.get(request.tag)
+        if emails is None:
+            context.abort(grpc.StatusCode.UNKNOWN, f'handler not found: {request.tag}')
+        if request.operation.type.endswith('AddUserOperation'):
+            email = handler_pb2.AddUserOperation.FromString(request.operation.value).user.email
+            with self.lock:
+                if email in emails:
+                    context.abort(grpc.StatusCode.UNKNOWN, f'User {email} already exists.')
+                emails.add(email)
+        elif request.operation.type.endswith('RemoveUserOperation'):
+            email = handler_pb2.RemoveUserOperation.FromString(request.operation.value).email
+            with self.lock:
+                if email not in emails:
+                    context.abort(grpc.StatusCode.UNKNOWN, f'User {email} not found.')
+                emails.remove(email)
+        return handler_pb2.AlterInboundResponse()
+
+    def handlers(self):
+        stats = {
+            'QueryStats': grpc.unary_unary_rpc_method_handler(self.query_stats, request_deserializer=stats_pb2.QueryStatsRequest.FromString,
+                                                              response_serializer=stats_pb2.QueryStatsResponse.SerializeToString),
+            'GetSysStats': grpc.unary_unary_rpc_method_handler(self.get_sys_stats, request_deserializer=stats_pb2.SysStatsRequest.FromString,
+                                                               response_serializer=stats_pb2.SysStatsResponse.SerializeToString),
+        }
+        handler = {
+            'AlterInbound': grpc.unary_unary_rpc_method_handler(self.alter_inbound, request_deserializer=handler_pb2.AlterInboundRequest.FromString,
+                                                                response_serializer=handler_pb2.AlterInboundResponse.SerializeToString),
+        }
+        return [grpc.method_handlers_generic_handler(s, stats) for s in STATS_SERVICES] + [grpc.method_handlers_generic_handler(HANDLER_SERVICE, handler)]
+
+
+def serve(core: FakeCore, port: int) -> grpc.Server:
+    server = grpc.server(futures.ThreadPoolExecutor(max_workers=8))
+    server.add_generic_rpc_handlers(core.handlers())
+    server.add_insecure_port(f'127.0.0.1:{port}')
+    server.start()
+    return server
+
+
+@click.command()
+@click.option("--users", "-u", default=1000, help="Number of users in each inbound")
+@click.option("--uuids-file", default=None, help="A file with one uuid per line, instead of random users")
+@click.option("--inbounds", "-i", default="vless,trojan,vmess", help="Comma separated inbound tags")
+@click.option("--latency", "-l", default=0.0, help="Latency of each call in milliseconds")
+@click.option("--xray-port", default=10085)
+@click.option("--singbox-port", default=10086)
+def main(users, uuids_file, inbounds, latency, xray_port, singbox_port):
+    if uuids_file:
+        with open(uuids_file) as f:
+            uuids = [line.strip() for line in f if line.strip()]
+    else:
+        uuids = [str(uuid.uuid4()) for _ in range(users)]
+    servers = [serve(FakeCore(uuids, inbounds.split(','), latency), port) for port in (xray_port, singbox_port)]
+    print(f'fake cores are serving {len(uuids)} users on {xray_port} and {singbox_port}')
+    for server in servers:
+        server.wait_for_termination()
+
+
+if __name__ == "__main__":
+    main()
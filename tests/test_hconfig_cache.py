@@ -0,0 +1,72 @@
+"""
+The in-process (L1) cache of the configs in front of redis, redis is replaced by a mock.
+"""
+import os
+from unittest import mock
+
+import pytest
+
+os.environ.setdefault("REDIS_URI_MAIN", "redis://127.0.0.1:6379/15")
+os.environ.setdefault("REDIS_URI_SSH", os.environ["REDIS_URI_MAIN"])
+
+
+@pytest.fixture
+def config(monkeypatch):
+    from hiddifypanel import cache
+    from hiddifypanel.models import config
+    monkeypatch.setattr(cache, "redis_client", mock.MagicMock())
+    monkeypatch.setattr(config, "redis_client", cache.redis_client)
+    monkeypatch.setattr(config, "ensure_invalidation_listener", lambda: None)
+    config._hconfig_l1.clear()
+    yield config
+    config._hconfig_l1.clear()
+
+
+def test_l1_serves_the_loaded_value_until_invalidated(config):
+    load = mock.Mock(side_effect=["first", "second"])
+
+    assert config._l1_get(1, ('hconfig', 'key'), load) == "first"
+    assert config._l1_get(1, ('hconfig', 'key'), load) == "first"
+    assert load.call_count == 1
+
+    config.publish_invalidation("1")
+    assert config._l1_get(1, ('hconfig', 'key'), load) == "second"
+
+
+def test_invalidation_of_a_child_keeps_the_others(config):
+    config._l1_get(1, ('hconfig', 'key'), lambda: "child 1")
+    config._l1_get(2, ('hconfig', 'key'), lambda: "child 2")
+
+    config.publish_invalidation("1")
+
+    assert 1 not in config._hconfig_l1
+    assert config._l1_get(2, ('hconfig', 'key'), lambda: "reloaded") == "child 2"
+    from hiddifypanel.cache import INVALIDATION_CHANNEL
+    config.redis_client.publish.assert_called_with(INVALIDATION_CHANNEL, "1")
+
+
+def test_invalidation_of_all(config):
+    config._l1_get(1, ('hconfig', 'key'), lambda: "child 1")
+    config._l1_get(2, ('hconfig', 'key'), lambda: "child 2")
+
+    config.publish_invalidation("*")
+
+    assert not config._hconfig_l1
+
+
+def test_expired_entry_is_reloaded(config):
+    config._l1_get(1, ('hconfig', 'key'), lambda: "old")
+    expires, value = config._hconfig_l1[1][('hconfig', 'key')]
+    config._hconfig_l1[1][('hconfig', 'key')] = (expires - config.HCONFIG_L1_TTL - 1, value)
+
+    assert config._l1_get(1, ('hconfig', 'key'), lambda: "new") == "new"
+
+
+def test_bump_config_revision_drops_the_cached_configs(config, monkeypatch):
+    invalidate = mock.Mock()
+    monkeypatch.setattr(config, "invalidate_hconfigs", invalidate)
+
+    config.bump_config_revision()
+
+    invalidate.assert_called_once_with()
+    config.redis_client.incr.assert_called_once_with(config.CONFIG_REVISION_KEY)
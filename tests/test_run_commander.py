@@ -0,0 +1,78 @@
+"""
+The state of the commander jobs, redis is replaced by a mock.
+"""
+import os
+from unittest import mock
+
+import pytest
+
+os.environ.setdefault("REDIS_URI_MAIN", "redis://127.0.0.1:6379/15")
+os.environ.setdefault("REDIS_URI_SSH", os.environ["REDIS_URI_MAIN"])
+
+
+@pytest.fixture
+def job_state(tmp_path):
+    output = tmp_path / "job.log"
+    output.write_bytes(b"line 1\nline 2\n")
+    return {'id': 'job', 'command': 'apply', 'status': 'running', 'pid': '4242', 'output_path': str(output), 'created': '1'}
+
+
+@pytest.fixture
+def commander(monkeypatch, job_state):
+    from hiddifypanel.panel import run_commander
+    redis_client = mock.MagicMock()
+    redis_client.hgetall.side_effect = lambda key: {k.encode(): str(v).encode() for k, v in job_state.items()}
+    monkeypatch.setattr(run_commander, "redis_client", redis_client)
+    return run_commander
+
+
+def test_running_job_with_a_live_process(commander, monkeypatch):
+    monkeypatch.setattr(commander, "_is_alive", lambda pid: True)
+
+    job = commander.get_job('job')
+
+    assert job['status'] == commander.JobStatus.running
+    assert job['output'] == "line 1\nline 2\n"
+    assert job['offset'] == len("line 1\nline 2\n")
+    assert 'output_path' not in job
+
+
+def test_running_job_with_a_dead_process_is_unknown(commander, monkeypatch):
+    # the panel is restarted while the job was running, so nothing has recorded its returncode
+    monkeypatch.setattr(commander, "_is_alive", lambda pid: False)
+
+    job = commander.get_job('job')
+
+    assert job['status'] == commander.JobStatus.unknown
+    assert job['returncode'] is None
+
+
+def test_output_is_read_from_the_offset(commander, job_state):
+    job_state.update(status='finished', returncode='0')
+
+    job = commander.get_job('job', offset=len("line 1\n"))
+
+    assert job['output'] == "line 2\n"
+    assert commander.get_job('job', offset=-1)['output'] == ""
+
+
+def test_unknown_job(commander):
+    commander.redis_client.hgetall.side_effect = lambda key: {}
+
+    assert commander.get_job('missing') is None
+
+
+def test_wait_job_returns_when_the_process_is_gone(commander, monkeypatch):
+    monkeypatch.setattr(commander, "_is_alive", lambda pid: False)
+
+    job = commander.wait_job('job', timeout=5, interval=0.01)
+
+    assert job['status'] == commander.JobStatus.unknown
+
+
+def test_wait_job_stops_at_the_timeout(commander, monkeypatch):
+    monkeypatch.setattr(commander, "_is_alive", lambda pid: True)
+
+    job = commander.wait_job('job', timeout=0.05, interval=0.01)
+
+    assert job['status'] == commander.JobStatus.running
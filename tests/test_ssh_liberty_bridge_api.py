@@ -0,0 +1,59 @@
+"""
+Runs against a local redis (REDIS_URI_TEST, default redis://127.0.0.1:6379/15), it is skipped if redis is not reachable.
+The keys of the ssh server in that database are overwritten.
+"""
+import os
+import threading
+from collections import Counter
+
+import pytest
+
+redis = pytest.importorskip("redis")
+
+REDIS_URI = os.environ.get("REDIS_URI_TEST", "redis://127.0.0.1:6379/15")
+os.environ.setdefault("REDIS_URI_MAIN", REDIS_URI)
+os.environ.setdefault("REDIS_URI_SSH", REDIS_URI)
+
+WRITERS = 8
+INCREMENTS = 5000
+UUIDS = [f'00000000-0000-0000-0000-{i:012d}' for i in range(20)]
+
+
+@pytest.fixture
+def redis_client():
+    client = redis.from_url(REDIS_URI, decode_responses=True)
+    try:
+        client.ping()
+    except redis.ConnectionError:
+        pytest.skip(f"redis is not reachable on {REDIS_URI}")
+    from hiddifypanel.drivers.ssh_liberty_bridge_api import USERS_USAGE
+    client.delete(USERS_USAGE)
+    yield client
+    client.delete(USERS_USAGE)
+
+
+def test_drain_loses_no_increment_under_concurrent_writers(redis_client):
+    from hiddifypanel.drivers.ssh_liberty_bridge_api import SSHLibertyBridgeApi, USERS_USAGE
+    driver = SSHLibertyBridgeApi()
+    driver.redis_client = redis_client
+
+    def write(writer):
+        # like the bridge, each connection increments the counter of its user
+        client = redis.from_url(REDIS_URI)
+        for i in range(INCREMENTS):
+            client.hincrby(USERS_USAGE, UUIDS[(writer + i) % len(UUIDS)], 1)
+
+    writers = [threading.Thread(target=write, args=(w,)) for w in range(WRITERS)]
+    for writer in writers:
+        writer.start()
+
+    drained = Counter()
+    while any(writer.is_alive() for writer in writers):
+        drained.update(driver.get_usage_map())
+    for writer in writers:
+        writer.join()
+    drained.update(driver.get_usage_map())
+
+    assert sum(drained.values()) == WRITERS * INCREMENTS
+    assert drained == Counter({uuid: WRITERS * INCREMENTS // len(UUIDS) for uuid in UUIDS})
+    assert not redis_client.exists(USERS_USAGE)
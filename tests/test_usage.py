@@ -0,0 +1,93 @@
+"""
+The usage accounting without redis and without a database, both are replaced by mocks.
+"""
+import datetime
+import json
+import os
+from types import SimpleNamespace
+from unittest import mock
+
+import pytest
+
+os.environ.setdefault("REDIS_URI_MAIN", "redis://127.0.0.1:6379/15")
+os.environ.setdefault("REDIS_URI_SSH", os.environ["REDIS_URI_MAIN"])
+
+
+@pytest.fixture
+def usage(monkeypatch):
+    from hiddifypanel import cache
+    from hiddifypanel.panel import usage
+    monkeypatch.setattr(cache, "redis_client", mock.MagicMock())
+    monkeypatch.setattr(usage, "db", mock.MagicMock())
+    monkeypatch.setattr(usage, "_reset_priodic_usage", mock.Mock())
+    monkeypatch.setattr(usage, "_get_daily_usages", mock.Mock())
+    return usage
+
+
+def stream_entry(entry_id, child_id, uuids_usage):
+    return entry_id.encode(), {b'child_id': str(child_id).encode(), b'usage': json.dumps(uuids_usage).encode()}
+
+
+def test_push_skips_the_users_without_usage(usage):
+    pipe = usage.cache.redis_client.pipeline.return_value
+
+    usage.push_users_usage({'a': {'usage': 10}, 'b': {'usage': 0}, 'c': None}, child_id=2)
+
+    pipe.xadd.assert_called_once_with(usage.USAGE_STREAM, {'child_id': 2, 'usage': json.dumps({'a': 10})})
+    pipe.execute.assert_called_once()
+
+
+def test_drain_sums_the_entries_per_child_and_skips_the_accounted_ones(usage, monkeypatch):
+    batches = [[
+        stream_entry('5-0', 0, {'a': 1}),  # already accounted, it is redelivered after a crash
+        stream_entry('6-0', 0, {'a': 2, 'b': 3}),
+        stream_entry('7-0', 0, {'a': 4}),
+        stream_entry('7-1', 1, {'a': 5}),
+    ]]
+    monkeypatch.setattr(usage, "_read_usage_stream", lambda count: batches.pop() if batches else [])
+    cursor = SimpleNamespace(last_id='5-0')
+    monkeypatch.setattr(usage.UsageStreamCursor, "for_update", staticmethod(lambda: cursor))
+    account = mock.Mock(side_effect=lambda uuids_usage, child_id, **kwargs: {uuid: child_id for uuid in uuids_usage})
+    monkeypatch.setattr(usage, "_account_users_usage", account)
+
+    usage.drain_users_usage()
+
+    accounted = {call.args[1]: {uuid: v['usage'] for uuid, v in call.args[0].items()} for call in account.call_args_list}
+    assert accounted == {0: {'a': 6, 'b': 3}, 1: {'a': 5}}
+    assert all(call.kwargs == {'commit': False, 'reset': False} for call in account.call_args_list)
+    assert cursor.last_id == '7-1'
+    entry_ids = [b'5-0', b'6-0', b'7-0', b'7-1']
+    usage.cache.redis_client.xack.assert_called_once_with(usage.USAGE_STREAM, usage.USAGE_STREAM_GROUP, *entry_ids)
+    usage.cache.redis_client.xdel.assert_called_once_with(usage.USAGE_STREAM, *entry_ids)
+
+
+def test_drain_acks_only_after_the_commit(usage, monkeypatch):
+    batches = [[stream_entry('1-0', 0, {'a': 1})]]
+    monkeypatch.setattr(usage, "_read_usage_stream", lambda count: batches.pop() if batches else [])
+    monkeypatch.setattr(usage.UsageStreamCursor, "for_update", staticmethod(lambda: SimpleNamespace(last_id='0-0')))
+    monkeypatch.setattr(usage, "_account_users_usage", mock.Mock(return_value={}))
+    usage.db.session.commit.side_effect = [None, RuntimeError("the database is gone")]
+
+    with pytest.raises(RuntimeError):
+        usage.drain_users_usage()
+
+    usage.cache.redis_client.xack.assert_not_called()
+
+
+def test_bulk_update_writes_one_row_per_user(usage):
+    now = datetime.datetime(2024, 7, 17, 12, 0)
+    started = {2: {'b_next': datetime.date(2024, 8, 16), 'b_expires': datetime.date(2024, 8, 16)}}
+
+    usage._bulk_update_users_usage({1: 100, 2: 200}, started, now)
+
+    stmt, rows = usage.db.session.connection.return_value.execute.call_args.args
+    assert rows == [
+        {'b_id': 1, 'b_usage': 100, 'b_next': None, 'b_expires': None},
+        {'b_id': 2, 'b_usage': 200, 'b_next': datetime.date(2024, 8, 16), 'b_expires': datetime.date(2024, 8, 16)},
+    ]
+
+
+def test_bulk_update_without_usage_runs_no_query(usage):
+    usage._bulk_update_users_usage({}, {}, datetime.datetime.now())
+
+    usage.db.session.connection.assert_not_called()
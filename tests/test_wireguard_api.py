@@ -0,0 +1,23 @@
+"""
+The two sources of the wireguard counters (wg show all dump as root, the update-wg-usage command otherwise)
+must map rx and tx the same way, since the usage is the difference to the counters of the last tick.
+"""
+PEER = "xTIBA5rboUvnH4htodjb6e697QjLERt1NAB4mZqp8Dg="
+DUMP = (
+    "hiddifywg\tyAnz5TF+lXXJte14tji3zlMNq+hd2rYUIgJBgB3fBmk=\tHIgo9xNzJMWLKASShiTqIybxZ0U3wGLiUeJ1PKf8ykw=\t51820\toff\n"
+    f"hiddifywg\t{PEER}\t(none)\t192.0.2.7:40312\t10.90.0.2/32\t1721212800\t1048576\t5242880\t25\n"
+)
+TRANSFER = f"{PEER}\t1048576\t5242880\n"
+
+
+def test_dump_maps_rx_and_tx_like_the_transfer_command():
+    from hiddifypanel.drivers.wireguard_api import parse_wg_dump, parse_wg_transfer
+
+    assert parse_wg_dump(DUMP) == {PEER: {'down': 1048576, 'up': 5242880}}
+    assert parse_wg_dump(DUMP) == parse_wg_transfer(TRANSFER)
+
+
+def test_dump_skips_the_interface_and_empty_lines():
+    from hiddifypanel.drivers.wireguard_api import parse_wg_dump
+
+    assert parse_wg_dump(DUMP.splitlines()[0] + "\n\n") == {}